@@ -0,0 +1,440 @@
+"""
+Fused long-form generation: concatenation, noise augmentation and
+segmentation in a single pass per long-form file.
+
+The staged recipe writes each long-form wav at p2, reads it back to add
+the noise and write it at p3, and reads it again to cut the segments.
+Here the waveform stays in memory between the three steps, and only the
+requested outputs are written: the noisy long-form files (as in p3),
+the segments (as in p3/SEG_N), or both.
+
+The manifests are the ones of the staged pipeline: data.csv and spk2utt
+for the long-form files, and data.csv, segment_comb_metadata.txt and
+asvspoof2019_trials.txt for the segments. The recipe of the combinations
+is written to out_data_dir, where the staged pipeline copies it.
+
+Resumable after a crash, see utils/journal.py, with the seeds of the
+journal if --seed or --noise_seed is not given.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+import soundfile as sf
+
+from long_form_concat import concatenate_audio, create_random_combination_batch
+from long_form_segmentation import (
+    label_segments,
+    part_samples,
+    segment_paths,
+    write_segment_manifests,
+    write_segments,
+)
+from noise_augmentation import (
+    DEFAULT_NOISE_METHODS,
+    MUSAN_DIR,
+    NOISE_METHODS,
+    RIR_DIR,
+    add_noise_pcm16,
+    rir_musan_loader,
+    utterance_rng,
+)
+from utils.get_spk2utt import write_spk2utt
+from utils.journal import Journal, atomic_output
+from utils.toy_corpus import write_toy_data_dir, write_toy_musan, write_toy_rirs
+
+
+# Concatenate, add noise and segment every long-form file of a recipe
+def fused_generation(
+    recipe,
+    noise_loader,
+    out_data_dir,
+    columns,
+    speaker="multi",
+    segment_data_dir=None,
+    segment_length_seconds=4,
+    write_long_form=True,
+    noise_seed=None,
+    samplerate=16000,
+    seed=None,
+):
+    """
+    seed: seed the recipe was drawn with, recorded for a restart
+    """
+    rows = []
+    segmentations = []
+    missing_wavs = []
+    # Long-form files completed by a previous run with the same settings
+    journal = Journal(out_data_dir + "/journal_fused.jsonl")
+    settings = dict(
+        noise_seed=noise_seed,
+        snr_range=list(noise_loader.noisesnr["noise"]),
+        noise_methods=noise_loader.noise_methods,
+        noise_bank_dir=(
+            None
+            if noise_loader.noise_bank is None
+            else noise_loader.noise_bank.bank_dir
+        ),
+        write_long_form=write_long_form,
+        segment_length=None if segment_data_dir is None else segment_length_seconds,
+    )
+    segment_samples = int(segment_length_seconds * samplerate)
+
+    # The wavs written for a long-form file of total_samples
+    def outputs(utt, total_samples):
+        paths = []
+        if write_long_form:
+            paths.append(out_data_dir + "/wavs/{}.wav".format(utt))
+        if segment_data_dir is not None:
+            paths += segment_paths(
+                utt, segment_data_dir + "/wavs", total_samples, segment_samples
+            )
+        return paths
+
+    num_resumed = 0
+    for i in range(len(recipe)):
+        utt, wav_paths, _, labels, decision = recipe.row(i)
+        record = journal.get(utt)
+        if record is not None and journal.done(
+            utt, outputs=outputs(utt, record["samples"]), sources=wav_paths, **settings
+        ):
+            num_resumed += 1
+        else:
+            wav_path_list = []
+            for wav_path in wav_paths:
+                if os.path.exists(wav_path):
+                    wav_path_list.append(wav_path)
+                else:
+                    missing_wavs.append(wav_path)
+
+            # The float waveform that the noise stage reads from the p2 wav
+            audio = concatenate_audio(wav_path_list, samplerate=samplerate)
+            rng = random if noise_seed is None else utterance_rng(noise_seed, utt)
+            params = {}
+            audio, _ = add_noise_pcm16(noise_loader, audio, rng=rng, params=params)
+
+            if write_long_form:
+                with atomic_output(out_data_dir + "/wavs/{}.wav".format(utt)) as tmp:
+                    sf.write(tmp, audio, samplerate)
+            if segment_data_dir is not None:
+                # Both 16-bit writes give the same samples as writing the
+                # long-form file and segmenting it after reading it back
+                write_segments(
+                    utt,
+                    audio,
+                    segment_data_dir + "/wavs",
+                    segment_length_seconds=segment_length_seconds,
+                    samplerate=samplerate,
+                )
+            journal.record(
+                utt,
+                sources=wav_paths,
+                samples=len(audio),
+                seed=seed,
+                **settings,
+                **params
+            )
+
+        if write_long_form:
+            wav_path = out_data_dir + "/wavs/{}.wav".format(utt)
+            noise_type = journal.get(utt)["method"]
+            rows.append([wav_path, decision, speaker, "longform-" + noise_type])
+        if segment_data_dir is not None:
+            segmentations.append(
+                label_segments(
+                    utt,
+                    part_samples(
+                        utt,
+                        wav_paths,
+                        total_samples=journal.get(utt)["samples"],
+                        samplerate=samplerate,
+                    ),
+                    labels,
+                    segment_samples,
+                    total_samples=journal.get(utt)["samples"],
+                )
+            )
+
+    journal.close()
+    if num_resumed > 0:
+        print("Resumed: {} long-form files already generated".format(num_resumed))
+    for wav_path in missing_wavs:
+        print("{} doesn't exist in wav paths".format(wav_path))
+
+    if write_long_form:
+        out_data_df = pd.DataFrame(rows, columns=columns)
+        with atomic_output(out_data_dir + "/data.csv") as tmp_path:
+            out_data_df.to_csv(tmp_path)
+        write_spk2utt(out_data_dir + "/data.csv")
+    if segment_data_dir is not None:
+        write_segment_manifests(segment_data_dir, segmentations, columns)
+
+
+# Simple unit test: the fused and the staged pipelines give the same files
+def unit_test():
+    pipeline_dir = os.path.dirname(os.path.abspath(__file__))
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        rng = np.random.default_rng(0)
+        in_data_dir = tmp_dir + "/p1"
+        write_toy_data_dir(in_data_dir, rng)
+        # Noise corpora where the stages look for them
+        write_toy_musan(os.path.join(tmp_dir, MUSAN_DIR), rng)
+        write_toy_rirs(os.path.join(tmp_dir, RIR_DIR), rng)
+
+        def run(script, *args):
+            subprocess.run(
+                [sys.executable, os.path.join(pipeline_dir, script)] + list(args),
+                cwd=tmp_dir,
+                check=True,
+                stdout=subprocess.DEVNULL,
+            )
+
+        recipe_args = ["--num_bonafides", "4", "--num_spoofs", "8", "--seed", "0"]
+        noise_args = [
+            "--snr_range",
+            "0_10",
+            "--noise_methods=" + ",".join(NOISE_METHODS),
+        ]
+        staged = tmp_dir + "/staged"
+        run(
+            "long_form_concat.py",
+            "--in_data_dir",
+            in_data_dir,
+            "--out_data_dir",
+            staged + "/p2",
+            *recipe_args
+        )
+        run("utils/get_spk2utt.py", staged + "/p2")
+        run("utils/get_utt2dur.py", staged + "/p2")
+        run(
+            "noise_augmentation.py",
+            "--in_data_dir",
+            staged + "/p2",
+            "--out_data_dir",
+            staged + "/p3",
+            "--seed",
+            "5",
+            "--num_workers",
+            "3",
+            "--chunk_size",
+            "2",
+            *noise_args
+        )
+        shutil.copy(staged + "/p2/src_comb_metadata_mc_3_7.txt", staged + "/p3")
+        shutil.copy(staged + "/p3/data.csv", staged + "/p3/data_sample.csv")
+        run(
+            "long_form_segmentation.py",
+            "--segment_length",
+            "1.5",
+            "--in_data_dir",
+            staged + "/p3",
+            "--out_data_dir",
+            staged + "/p3/SEG1.5",
+        )
+
+        fused = tmp_dir + "/fused"
+        run(
+            "fused_long_form.py",
+            "--in_data_dir",
+            in_data_dir,
+            "--out_data_dir",
+            fused + "/p3",
+            "--segment_length",
+            "1.5",
+            "--noise_seed",
+            "5",
+            "--noise_bank_dir",
+            tmp_dir + "/bank",
+            "--inventory_dir",
+            tmp_dir + "/inventory",
+            *(recipe_args + noise_args)
+        )
+
+        names = [
+            "data.csv",
+            "spk2utt",
+            "SEG1.5/data.csv",
+            "SEG1.5/segment_comb_metadata.txt",
+            "SEG1.5/asvspoof2019_trials.txt",
+        ]
+        for wav_dir in ["wavs", "SEG1.5/wavs"]:
+            wavs = sorted(os.listdir(staged + "/p3/" + wav_dir))
+            assert wavs == sorted(os.listdir(fused + "/p3/" + wav_dir)), wav_dir
+            names += [wav_dir + "/" + wav for wav in wavs]
+        for name in names:
+            with open(staged + "/p3/" + name, "rb") as f:
+                expected = f.read().replace(b"/staged/", b"/fused/")
+            with open(fused + "/p3/" + name, "rb") as f:
+                assert f.read() == expected, name
+
+        # The virtual dataset gives the samples of the staged p3 wavs
+        from virtual_long_form import VirtualLongForm
+
+        dataset = VirtualLongForm(
+            staged + "/p2/src_comb_metadata_mc_3_7.npz",
+            snr_range=[0, 10],
+            seed=5,
+            musan_path=os.path.join(tmp_dir, MUSAN_DIR),
+            rir_path=os.path.join(tmp_dir, RIR_DIR),
+            noise_methods=NOISE_METHODS,
+        )
+        for name, audio, _, _ in dataset:
+            written, _ = sf.read(
+                staged + "/p3/wavs/{}.wav".format(name), dtype="float32"
+            )
+            assert np.array_equal(audio, written), name
+        print("Fused, staged and virtual pipelines give identical samples")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--in_data_dir", type=str, help="Input data directory", required=True
+    )
+    parser.add_argument(
+        "--out_data_dir",
+        type=str,
+        help="Output data directory of the noisy long-form files",
+        required=True,
+    )
+    parser.add_argument(
+        "--outputs",
+        type=str,
+        default="both",
+        choices=["long_form", "segments", "both"],
+        help="Which wavs to write",
+    )
+
+    # Concatenation, as in long_form_concat.py
+    parser.add_argument(
+        "--single_speaker",
+        action="store_true",
+        help="Whether we only concat wavs from the same speaker",
+    )
+    parser.add_argument("--num_bonafides", type=int, default=2580)
+    parser.add_argument("--num_spoofs", type=int, default=22800)
+    parser.add_argument("--num_bonafides_single", type=int, default=3)
+    parser.add_argument("--num_spoofs_single", type=int, default=7)
+    parser.add_argument("--seed", type=int, default=None)
+
+    # Noise augmentation, as in noise_augmentation.py
+    parser.add_argument("--snr_range", type=str, required=True)
+    parser.add_argument("--noise_seed", type=int, default=None)
+    parser.add_argument("--noise_bank_dir", type=str, default=None)
+    parser.add_argument("--inventory_dir", type=str, default=None)
+    parser.add_argument(
+        "--noise_methods",
+        type=str,
+        default=",".join(DEFAULT_NOISE_METHODS),
+        help="Comma-separated methods, passed as --noise_methods=-,reverb,...",
+    )
+
+    # Segmentation, as in long_form_segmentation.py
+    parser.add_argument("--segment_length", type=float, default=4.0)
+    parser.add_argument(
+        "--segment_data_dir",
+        type=str,
+        default=None,
+        help="Output data directory of the segments, out_data_dir/SEG<N> by default",
+    )
+
+    args = parser.parse_args()
+
+    in_data_dir = args.in_data_dir
+    out_data_dir = args.out_data_dir
+    for i in ["data.csv", "spk2utt", "wavs", "utt2dur"]:
+        assert os.path.exists(in_data_dir + "/" + i)
+
+    segment_data_dir = None
+    if args.outputs != "long_form":
+        segment_data_dir = args.segment_data_dir
+        if segment_data_dir is None:
+            segment_data_dir = out_data_dir + "/SEG{:g}".format(args.segment_length)
+        os.makedirs(segment_data_dir + "/wavs", exist_ok=True)
+    os.makedirs(out_data_dir + "/wavs", exist_ok=True)
+
+    in_data_df = pd.read_csv(in_data_dir + "/data.csv")
+    in_data_df = in_data_df.drop(columns=["Unnamed: 0"])
+    bonafide_wav_files = in_data_df[in_data_df["label"] == "bonafide"]["file"].tolist()
+    spoof_wav_files = in_data_df[in_data_df["label"] == "spoof"]["file"].tolist()
+
+    # A restarted run draws the same recipe and noise, from the seeds of
+    # the journal
+    journal = Journal(out_data_dir + "/journal_fused.jsonl")
+    seed = args.seed
+    if seed is None:
+        seed = journal.last("seed")
+        if seed is not None:
+            print("No --seed given, resuming with the seed {}".format(seed))
+        else:
+            seed = random.SystemRandom().randrange(2**32)
+            print("No --seed given, seed {}".format(seed))
+    noise_seed = args.noise_seed
+    if noise_seed is None:
+        noise_seed = journal.last("noise_seed")
+        if noise_seed is not None:
+            print(
+                "No --noise_seed given, resuming with the noise seed {}".format(
+                    noise_seed
+                )
+            )
+        else:
+            noise_seed = random.SystemRandom().randrange(2**32)
+            print("No --noise_seed given, noise seed {}".format(noise_seed))
+
+    recipe = create_random_combination_batch(
+        bonafide_wav_files,
+        spoof_wav_files,
+        in_data_dir + "/utt2dur",
+        out_data_dir,
+        spk2utt_file=in_data_dir + "/spk2utt" if args.single_speaker else None,
+        num_bonafides=args.num_bonafides,
+        num_spoofs=args.num_spoofs,
+        num_bonafides_single=args.num_bonafides_single,
+        num_spoofs_single=args.num_spoofs_single,
+        seed=seed,
+    )
+
+    snr_range = [int(i) for i in args.snr_range.split("_")]
+    noise_loader = rir_musan_loader(
+        MUSAN_DIR,
+        RIR_DIR,
+        snr_range=snr_range,
+        noise_bank_dir=args.noise_bank_dir,
+        inventory_dir=args.inventory_dir,
+        noise_methods=args.noise_methods.split(","),
+    )
+
+    fused_generation(
+        recipe,
+        noise_loader,
+        out_data_dir,
+        in_data_df.columns,
+        speaker="single" if args.single_speaker else "multi",
+        segment_data_dir=segment_data_dir,
+        segment_length_seconds=args.segment_length,
+        write_long_form=args.outputs != "segments",
+        noise_seed=noise_seed,
+        seed=seed,
+    )
+    print(
+        "Finish generating {} long-form files in one pass. Outputs: {}".format(
+            len(recipe), args.outputs
+        )
+    )
+
+
+if __name__ == "__main__":
+    # unit_test()
+    main()
@@ -10,278 +10,292 @@ The source should have below architectures:
 We need spk2utt to determine whether concatenation should
 be limited to each speaker or include short waveforms from
 multiple speakers.
+
+Resumable after a crash, see utils/journal.py, with the seed of the
+journal if --seed is not given.
 """
 
 import argparse
+import json
 import os
 import random
+import shutil
+import tempfile
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import chain
 
+import numpy as np
 import pandas as pd
-from pydub import AudioSegment
+import soundfile as sf
 
+from utils.corpus_cache import CorpusCache
+from utils.journal import Journal, atomic_output
+from utils.recipe import Recipe
+from utils.toy_corpus import write_toy_data_dir
 
-# Randomly generate combinations of bonafide and spoof wavs for concatenation
-def create_random_combination(
-    bonafide_wav_files,
-    spoof_wav_files,
-    wav2dur_file,
-    out_data_dir,
-    num_bonafides=2580,
-    num_spoofs=22800,
-    num_bonafides_single=3,
-    num_spoofs_single=7,
+
+# Load the utterance -> speaker hash index from spk2utt
+def load_utt2spk(spk2utt_file):
+    utt2spk = {}
+    with open(spk2utt_file, "r") as s:
+        for line in s:
+            parts = line.strip().split()
+            for utt in parts[1:]:
+                utt2spk[utt] = parts[0]
+    return utt2spk
+
+
+# Index wavs by speaker, as arrays of positions in the wav file list
+def index_wavs_by_spk(wav_files, utt2spk=None):
+    """
+    Map each speaker to the NumPy array of positions of its wavs.
+    Without utt2spk, all wavs belong to a single None speaker.
+    """
+    if utt2spk is None:
+        return {None: np.arange(len(wav_files))}
+    wav_by_spk = defaultdict(list)
+    for i, wav in enumerate(wav_files):
+        spk = utt2spk.get(os.path.basename(wav).split(".")[0])
+        if spk is not None:
+            wav_by_spk[spk].append(i)
+    return {spk: np.array(idx) for spk, idx in wav_by_spk.items()}
+
+
+# Speakers that have enough wavs for each type of long-form file
+def eligible_speakers(
+    bonafide_by_spk,
+    spoof_by_spk,
+    num_bonafides,
+    num_spoofs,
+    num_bonafides_single,
+    num_spoofs_single,
 ):
     """
-    Create random combination of the wav files and write metadata
+    Return the speakers that can fill a bonafide and a spoof long-form
+    file, and fail fast if there is none for a type that is requested.
     """
-    comb_metadata = open(
-        out_data_dir
-        + "/src_comb_metadata_mc_{}_{}.txt".format(
-            num_bonafides_single, num_spoofs_single
-        ),
-        "w",
-    )
-
-    # Load utterance durations from file
-    wav2dur = {}
-    with open(wav2dur_file, "r") as u:
-        for line in u:
-            wav, dur = line.split()
-            wav2dur[wav] = dur
-
-    # Generate bonafide combinations for long-form utterances
+    empty = np.array([], dtype=int)
     num_bonafides_single_for_bonafide = num_bonafides_single + num_spoofs_single
-    bonafide_wav_idx = 0
-    while bonafide_wav_idx < num_bonafides:
-        comb_bonafide_wav_name = "LA_bonafide_{}_{}".format(
-            num_bonafides_single_for_bonafide, bonafide_wav_idx
-        )
-        comb_bonafide_wavs = random.sample(
-            bonafide_wav_files, num_bonafides_single_for_bonafide
+    bonafide_speakers = [
+        spk
+        for spk, idx in bonafide_by_spk.items()
+        if len(idx) >= num_bonafides_single_for_bonafide
+    ]
+    spoof_speakers = [
+        spk
+        for spk, idx in spoof_by_spk.items()
+        if len(idx) >= num_spoofs_single
+        and len(bonafide_by_spk.get(spk, empty)) >= num_bonafides_single
+    ]
+    if num_bonafides > 0 and len(bonafide_speakers) == 0:
+        raise ValueError(
+            "No speaker has at least {} bonafide wavs for a bonafide "
+            "long-form file".format(num_bonafides_single_for_bonafide)
         )
-        random.shuffle(comb_bonafide_wavs)
-        comb_bonafide_utts = []
-        comb_bonafide_durs = []
-        comb_bonafide_labels = []
-        for wav in comb_bonafide_wavs:
-            # Append duration and label
-            dur = wav2dur[wav]
-            comb_bonafide_utts.append(wav)
-            comb_bonafide_durs.append(str(dur))
-            comb_bonafide_labels.append("b")
-        comb_metadata.write(
-            "{} {} {} {} bonafide\n".format(
-                comb_bonafide_wav_name,
-                ",".join(comb_bonafide_utts),
-                ",".join(comb_bonafide_durs),
-                ",".join(comb_bonafide_labels),
-            )
-        )
-        bonafide_wav_idx += 1
-
-    # Generate spoof combinations for long-form utterances
-    spoof_wav_idx = 0
-    while spoof_wav_idx < num_spoofs:
-        comb_spoof_wav_name = "LA_spoof_{}_{}_{}".format(
-            num_bonafides_single, num_spoofs_single, spoof_wav_idx
-        )
-        comb_spoof_wavs = random.sample(
-            bonafide_wav_files, num_bonafides_single
-        ) + random.sample(spoof_wav_files, num_spoofs_single)
-        random.shuffle(comb_spoof_wavs)
-        comb_spoof_utts = []
-        comb_spoof_durs = []
-        comb_spoof_labels = []
-        for wav in comb_spoof_wavs:
-            # Append duration and label
-            dur = wav2dur[wav]
-            comb_spoof_utts.append(wav)
-            comb_spoof_durs.append(dur)
-            label = "s" if wav in spoof_wav_files else "b"
-            comb_spoof_labels.append(label)
-
-        comb_metadata.write(
-            "{} {} {} {} spoof\n".format(
-                comb_spoof_wav_name,
-                ",".join(comb_spoof_utts),
-                ",".join(comb_spoof_durs),
-                ",".join(comb_spoof_labels),
-            )
-        )
-        spoof_wav_idx += 1
-    print(
-        "Metadata of list to create long-form files have been written to {}".format(
-            out_data_dir
-            + "/src_comb_metadata_mc_{}_{}.txt".format(
-                num_bonafides_single, num_spoofs_single
-            )
+    if num_spoofs > 0 and len(spoof_speakers) == 0:
+        raise ValueError(
+            "No speaker has at least {} bonafide and {} spoof wavs for a spoof "
+            "long-form file".format(num_bonafides_single, num_spoofs_single)
         )
-    )
-    comb_metadata.close()
+    return bonafide_speakers, spoof_speakers
 
 
-# Generate combinations with speaker constraint (single-speaker mode)
-def create_random_combination_single_spk(
+# Draw rows of distinct items from a pool, all rows at once
+def sample_rows(rng, pool, num_rows, k):
+    """
+    Return a (num_rows, k) array where each row holds k distinct items of
+    pool, drawn with a numpy.random.Generator
+    """
+    if len(pool) < k:
+        raise ValueError("Cannot draw {} items from {}".format(k, len(pool)))
+    if len(pool) <= 4 * k:
+        # Small pool: k smallest random keys of each row
+        keys = rng.random((num_rows, len(pool)))
+        return pool[np.argsort(keys, axis=1)[:, :k]]
+
+    # Large pool: draw with replacement and redraw the rows with duplicates
+    draws = rng.integers(0, len(pool), size=(num_rows, k))
+    redraw = np.arange(num_rows)
+    while len(redraw) > 0:
+        rows = np.sort(draws[redraw], axis=1)
+        redraw = redraw[(rows[:, 1:] == rows[:, :-1]).any(axis=1)]
+        draws[redraw] = rng.integers(0, len(pool), size=(len(redraw), k))
+    return pool[draws]
+
+
+# Vectorized generator of all combinations, stored as a compact recipe
+def create_random_combination_batch(
     bonafide_wav_files,
     spoof_wav_files,
-    spk2utt_file,
     utt2dur_file,
     out_data_dir,
+    spk2utt_file=None,
     num_bonafides=2580,
     num_spoofs=22800,
     num_bonafides_single=3,
     num_spoofs_single=7,
+    seed=None,
 ):
     """
-    Create random combination of wav files, with optional speaker constraint.
+    Draw all combinations in one batch, save them as a .npz recipe and
+    export the src_comb_metadata_*.txt file. With spk2utt_file, all the
+    wavs of a long-form file come from the same speaker.
     """
-    comb_metadata = open(
-        os.path.join(
-            out_data_dir,
-            "src_comb_metadata_sc_{}_{}.txt".format(
-                num_bonafides_single, num_spoofs_single
-            ),
-        ),
-        "w",
-    )
+    rng = np.random.default_rng(seed)
 
-    # Load utterance durations
+    # Utterance table: bonafide wavs first, then spoof wavs
+    paths = list(bonafide_wav_files) + list(spoof_wav_files)
+    labels = np.repeat([0, 1], [len(bonafide_wav_files), len(spoof_wav_files)])
     utt2dur = {}
     with open(utt2dur_file, "r") as u:
         for line in u:
             utt, dur = line.split()
-            utt2dur[utt] = dur
-
-    # Load speaker-to-utterance mapping
-    spk2utt = defaultdict(list)
-    if spk2utt_file:
-        with open(spk2utt_file, "r") as s:
-            for line in s:
-                parts = line.strip().split()
-                spk = parts[0]
-                utts = parts[1:]
-                spk2utt[spk].extend(utts)
-
-    # Index bonafide and spoof wavs by speaker
-    if spk2utt_file:
-        bonafide_by_spk = defaultdict(list)
-        spoof_by_spk = defaultdict(list)
-
-        for wav in bonafide_wav_files:
-            utt = os.path.basename(wav).split(".")[0]
-            for spk, utts in spk2utt.items():
-                if utt in utts:
-                    bonafide_by_spk[spk].append(wav)
-                    break
-
-        for wav in spoof_wav_files:
-            utt = os.path.basename(wav).split(".")[0]
-            for spk, utts in spk2utt.items():
-                if utt in utts:
-                    spoof_by_spk[spk].append(wav)
-                    break
-    else:
-        bonafide_by_spk = {None: bonafide_wav_files}
-        spoof_by_spk = {None: spoof_wav_files}
-
-    # Create bonafide concatenation combinations by speaker
-    bonafide_wav_idx = 0
-    while bonafide_wav_idx < num_bonafides:
-        spk = random.choice(list(bonafide_by_spk.keys()))
-        if len(bonafide_by_spk[spk]) < num_bonafides_single + num_spoofs_single:
-            continue  # Skip speakers with insufficient samples
-
-        comb_bonafide_wav_name = "LA_bonafide_{}_{}".format(
-            num_bonafides_single + num_spoofs_single, bonafide_wav_idx
-        )
-        comb_bonafide_wavs = random.sample(
-            bonafide_wav_files, num_bonafides_single + num_spoofs_single
-        )
-        random.shuffle(comb_bonafide_wavs)
-        comb_bonafide_utts = []
-        comb_bonafide_durs = []
-        comb_bonafide_labels = []
-        for wav in comb_bonafide_wavs:
-            dur = utt2dur[wav]
-            comb_bonafide_utts.append(wav)
-            comb_bonafide_durs.append(str(dur))
-            comb_bonafide_labels.append("b")
-        comb_metadata.write(
-            "{} {} {} {} bonafide\n".format(
-                comb_bonafide_wav_name,
-                ",".join(comb_bonafide_utts),
-                ",".join(comb_bonafide_durs),
-                ",".join(comb_bonafide_labels),
-            )
-        )
-
-        bonafide_wav_idx += 1
+            utt2dur[utt] = round(float(dur) * 1000)
+    durations_ms = [utt2dur[path] for path in paths]
+
+    utt2spk = load_utt2spk(spk2utt_file) if spk2utt_file else None
+    bonafide_by_spk = index_wavs_by_spk(bonafide_wav_files, utt2spk)
+    spoof_by_spk = {
+        spk: idx + len(bonafide_wav_files)
+        for spk, idx in index_wavs_by_spk(spoof_wav_files, utt2spk).items()
+    }
+    bonafide_speakers, spoof_speakers = eligible_speakers(
+        bonafide_by_spk,
+        spoof_by_spk,
+        num_bonafides,
+        num_spoofs,
+        num_bonafides_single,
+        num_spoofs_single,
+    )
 
-    # Create spoof concatenation combinations by speaker
-    spoof_wav_idx = 0
-    while spoof_wav_idx < num_spoofs:
-        spk = random.choice(list(spk2utt.keys()))
-        if (
-            len(bonafide_by_spk[spk]) < num_bonafides_single
-            or len(spoof_by_spk[spk]) < num_spoofs_single
-        ):
-            continue  # Skip speakers with insufficient samples
+    # Draw the speaker of every long-form file, then the wavs of all the
+    # files of a speaker at once
+    num_parts = num_bonafides_single + num_spoofs_single
+    bonafide_parts = np.zeros((num_bonafides, num_parts), dtype=np.int32)
+    spk_ids = rng.integers(0, max(len(bonafide_speakers), 1), size=num_bonafides)
+    for i, spk in enumerate(bonafide_speakers):
+        rows = np.flatnonzero(spk_ids == i)
+        bonafide_parts[rows] = sample_rows(
+            rng, bonafide_by_spk[spk], len(rows), num_parts
+        )
 
-        comb_spoof_wav_name = "LA_spoof_{}_{}_{}".format(
-            num_bonafides_single, num_spoofs_single, spoof_wav_idx
+    spoof_parts = np.zeros((num_spoofs, num_parts), dtype=np.int32)
+    spk_ids = rng.integers(0, max(len(spoof_speakers), 1), size=num_spoofs)
+    for i, spk in enumerate(spoof_speakers):
+        rows = np.flatnonzero(spk_ids == i)
+        spoof_parts[rows, :num_bonafides_single] = sample_rows(
+            rng, bonafide_by_spk[spk], len(rows), num_bonafides_single
         )
-        comb_spoof_wavs = random.sample(
-            bonafide_wav_files, num_bonafides_single
-        ) + random.sample(spoof_wav_files, num_spoofs_single)
-        random.shuffle(comb_spoof_wavs)
-        comb_spoof_utts = []
-        comb_spoof_durs = []
-        comb_spoof_labels = []
-        for wav in comb_spoof_wavs:
-            dur = utt2dur[wav]
-            comb_spoof_utts.append(wav)
-            comb_spoof_durs.append(dur)
-            label = "s" if wav in spoof_wav_files else "b"
-            comb_spoof_labels.append(label)
-
-        comb_metadata.write(
-            "{} {} {} {} spoof\n".format(
-                comb_spoof_wav_name,
-                ",".join(comb_spoof_utts),
-                ",".join(comb_spoof_durs),
-                ",".join(comb_spoof_labels),
-            )
+        spoof_parts[rows, num_bonafides_single:] = sample_rows(
+            rng, spoof_by_spk[spk], len(rows), num_spoofs_single
         )
+    spoof_parts = rng.permuted(spoof_parts, axis=1)
+
+    names = ["LA_bonafide_{}_{}".format(num_parts, i) for i in range(num_bonafides)]
+    names += [
+        "LA_spoof_{}_{}_{}".format(num_bonafides_single, num_spoofs_single, i)
+        for i in range(num_spoofs)
+    ]
+    recipe = Recipe(
+        names,
+        ["bonafide"] * num_bonafides + ["spoof"] * num_spoofs,
+        np.concatenate([bonafide_parts, spoof_parts]),
+        paths,
+        durations_ms,
+        labels,
+    )
 
-        spoof_wav_idx += 1
-
+    recipe_name = "src_comb_metadata_{}_{}_{}".format(
+        "sc" if spk2utt_file else "mc", num_bonafides_single, num_spoofs_single
+    )
+    recipe.save(os.path.join(out_data_dir, recipe_name + ".npz"))
+    recipe.to_text(os.path.join(out_data_dir, recipe_name + ".txt"))
     print(
-        "Metadata written to {}".format(
-            os.path.join(
-                out_data_dir,
-                "src_comb_metadata_sc_{}_{}.txt".format(
-                    num_bonafides_single, num_spoofs_single
-                ),
-            )
+        "Metadata of list to create long-form files have been written to {}".format(
+            os.path.join(out_data_dir, recipe_name + ".{npz,txt}")
         )
     )
-    comb_metadata.close()
+    return recipe
+
+
+# Decode the list of wavs into one preallocated buffer
+def concatenate_audio(wav_paths, samplerate=16000, cache=None):
+    """
+    Concatenate multiple wavs into one int16 array. The sample count of
+    each part is taken from its header (or the cache index), so the
+    output is allocated once and every part is decoded straight into its
+    slice. Parts found in the decoded corpus cache are copied from it.
+    """
+    lengths = []
+    for path in wav_paths:
+        if cache is not None and path in cache:
+            lengths.append(cache.index[path][1])
+            continue
+        info = sf.info(path)
+        if info.samplerate != samplerate or info.channels != 1:
+            raise ValueError(
+                "{} is {} Hz with {} channels, expected {} Hz mono".format(
+                    path, info.samplerate, info.channels, samplerate
+                )
+            )
+        lengths.append(info.frames)
+
+    offsets = np.cumsum([0] + lengths)
+    concatenated_audio = np.empty(offsets[-1], dtype=np.int16)
+    for path, start, end in zip(wav_paths, offsets[:-1], offsets[1:]):
+        if cache is not None and path in cache:
+            concatenated_audio[start:end] = cache.get(path)
+        else:
+            with sf.SoundFile(path) as f:
+                f.read(dtype="int16", out=concatenated_audio[start:end])
+    return concatenated_audio
 
 
 # Concatenate the list of wavs into a single long-form file
-def concatenation_single(wav_paths, output_path):
+def concatenation_single(wav_paths, output_path, samplerate=16000, cache=None):
     """
     Concatenate multiple wavs into one.
     """
-    # Create empty AudioSegment and concatenate each wav
-    concatenated_wav = AudioSegment.empty()
+    # The 16-bit PCM wav is bit-identical to what pydub used to export
+    concatenated_audio = concatenate_audio(
+        wav_paths, samplerate=samplerate, cache=cache
+    )
+    with atomic_output(output_path) as tmp_path:
+        sf.write(
+            tmp_path, concatenated_audio, samplerate, format="WAV", subtype="PCM_16"
+        )
+    return len(concatenated_audio)
 
-    for path in wav_paths:
-        wav = AudioSegment.from_file(path)
-        concatenated_wav += wav
 
-    concatenated_wav.export(output_path, format="wav")
+# Concatenate a chunk of long-form files, in a worker process or not
+def concatenation_chunk(jobs, cache_handle=None):
+    """
+    Concatenate a chunk of (utt, wav paths, output path) jobs. Returns the
+    (utt, missing input wavs, number of samples) of every job, in order.
+    """
+    cache = CorpusCache.attach(cache_handle) if cache_handle is not None else None
+    results = []
+    try:
+        for utt, concat_wav_paths_list, concat_wav_path in jobs:
+            wav_path_list = []
+            missing_wavs = []
+            for wav_path in concat_wav_paths_list:
+                if os.path.exists(wav_path):
+                    wav_path_list.append(wav_path)
+                else:
+                    missing_wavs.append(wav_path)
+
+            # Concatenate and save the new long-form wav
+            num_samples = concatenation_single(
+                wav_path_list, concat_wav_path, cache=cache
+            )
+            results.append((utt, missing_wavs, num_samples))
+    finally:
+        if cache is not None:
+            cache.close()
+    return results
 
 
 # Orchestrates concatenation according to generated metadata
@@ -292,60 +306,90 @@ def concatenation(
     num_bonafides_single,
     num_spoofs_single,
     single_speaker=False,
+    cache=None,
+    num_workers=1,
+    chunk_size=16,
+    seed=None,
 ):
     """
     Perform concatenation according to the metadata file fetched.
+    seed: seed the recipe was drawn with, recorded for a restart
+    The output name of each long-form file only depends on the recipe,
+    so the wavs, trials and data.csv are the same for any num_workers.
     """
     print("Begin concatenating wav files.......")
-    if single_speaker:
-        src_comb_metadata = out_data_dir + "/src_comb_metadata_sc_{}_{}.txt".format(
-            num_bonafides_single, num_spoofs_single
-        )
+    # Read the binary recipe when it is there, else parse the text one
+    src_comb_metadata = out_data_dir + "/src_comb_metadata_{}_{}_{}".format(
+        "sc" if single_speaker else "mc", num_bonafides_single, num_spoofs_single
+    )
+    if os.path.exists(src_comb_metadata + ".npz"):
+        recipe = Recipe.load(src_comb_metadata + ".npz")
     else:
-        src_comb_metadata = out_data_dir + "/src_comb_metadata_mc_{}_{}.txt".format(
-            num_bonafides_single, num_spoofs_single
-        )
+        recipe = Recipe.load(src_comb_metadata + ".txt")
     out_trial_txt = out_data_dir + "/asvspoof2019_trials.txt"
     out_data_csv = out_data_dir + "/data.csv"
-    out_data_df = pd.DataFrame(columns=src_data_df.columns)
-
-    num_bonafide_concat_wavs = 0
-    num_spoof_concat_wavs = 0
-    with open(src_comb_metadata, "r") as s, open(out_trial_txt, "w") as w:
-        for line in s:
-            # Parse metadata line
-            utt, concat_wav_paths, _, _, decision = line.split()
-            concat_wav_paths_list = concat_wav_paths.split(",")
-
-            wav_path_list = []
-            for wav_path in concat_wav_paths_list:
-                if os.path.exists(wav_path):
-                    wav_path_list.append(wav_path)
-                else:
-                    print("{} doesn't exist in wav paths".format(wav_path))
-                    continue
-
-            # Concatenate and save the new long-form wav
+    # Long-form files completed by a previous run with the same recipe
+    journal = Journal(out_data_dir + "/journal_concat.jsonl")
+
+    jobs = []
+    rows = []
+    utts = []
+    speaker = "single" if single_speaker else "multi"
+    with open(out_trial_txt, "w") as w:
+        for i in range(len(recipe)):
+            utt, concat_wav_paths_list, _, _, decision = recipe.row(i)
             concat_wav_path = out_data_dir + "/wavs/{}.wav".format(utt)
-            concatenation_single(wav_path_list, concat_wav_path)
-
-            if decision == "bonafide":
-                num_bonafide_concat_wavs += 1
-            else:
-                num_spoof_concat_wavs += 1
+            if not journal.done(
+                utt, outputs=[concat_wav_path], sources=concat_wav_paths_list
+            ):
+                jobs.append((utt, concat_wav_paths_list, concat_wav_path))
 
             w.write("{} {} - - {}\n".format(utt, utt, decision))
+            utts.append(utt)
+            rows.append([concat_wav_path, decision, speaker, "longform"])
+    if len(jobs) < len(recipe):
+        print(
+            "Resuming: {} of {} long-form files already concatenated".format(
+                len(recipe) - len(jobs), len(recipe)
+            )
+        )
 
-            speaker = "single" if single_speaker else "multi"
-            out_data_df.loc[len(out_data_df)] = [
-                concat_wav_path,
-                decision,
-                speaker,
-                "longform",
-            ]
-
-    out_data_df.to_csv(out_data_dir + "/data.csv")
+    chunks = [jobs[i : i + chunk_size] for i in range(0, len(jobs), chunk_size)]
+    sources = {utt: wav_paths for utt, wav_paths, _ in jobs}
+    cache_handle = cache.handle() if cache is not None else None
+    worker = partial(concatenation_chunk, cache_handle=cache_handle)
+
+    # The main process records the long-form files as the chunks come back
+    def record(results):
+        for utt, missing_wavs, num_samples in results:
+            journal.record(
+                utt,
+                sources=sources[utt],
+                missing=missing_wavs,
+                samples=num_samples,
+                seed=seed,
+            )
 
+    try:
+        if num_workers > 1:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                record(chain.from_iterable(executor.map(worker, chunks)))
+        else:
+            for chunk in chunks:
+                record(worker(chunk))
+    finally:
+        journal.close()
+    for utt in utts:
+        for wav_path in journal.get(utt)["missing"]:
+            print("{} doesn't exist in wav paths".format(wav_path))
+
+    # Build the dataframe once from the gathered rows
+    out_data_df = pd.DataFrame(rows, columns=src_data_df.columns)
+    with atomic_output(out_data_csv) as tmp_path:
+        out_data_df.to_csv(tmp_path)
+
+    num_bonafide_concat_wavs = int(np.sum(recipe.decisions == "bonafide"))
+    num_spoof_concat_wavs = len(recipe) - num_bonafide_concat_wavs
     print(
         "Concatenated {} wav files. Bonafide: {}, Spoof: {}".format(
             num_bonafide_concat_wavs + num_spoof_concat_wavs,
@@ -380,6 +424,19 @@ def main():
     parser.add_argument("--num_bonafides_single", type=int, default=3)
     parser.add_argument("--num_spoofs_single", type=int, default=7)
 
+    parser.add_argument(
+        "--num_workers", type=int, default=1, help="Number of worker processes"
+    )
+
+    # Seed of the combination generator, random (and printed) if not given
+    parser.add_argument("--seed", type=int, default=None)
+
+    # Optional cache of the decoded input corpus, 0 to read wavs from disk
+    parser.add_argument("--cache_memory_mb", type=int, default=0)
+    parser.add_argument(
+        "--cache_backend", type=str, default="shm", choices=["shm", "mmap"]
+    )
+
     args = parser.parse_args()
 
     in_data_dir = args.in_data_dir
@@ -397,40 +454,130 @@ def main():
     bonafide_wav_files = in_data_df[in_data_df["label"] == "bonafide"]["file"].tolist()
     spoof_wav_files = in_data_df[in_data_df["label"] == "spoof"]["file"].tolist()
 
+    # A restarted run draws the same recipe, from the seed of the journal
+    seed = args.seed
+    if seed is None:
+        seed = Journal(out_data_dir + "/journal_concat.jsonl").last("seed")
+        if seed is not None:
+            print("No --seed given, resuming with the seed {}".format(seed))
+        else:
+            seed = random.SystemRandom().randrange(2**32)
+            print("No --seed given, seed {}".format(seed))
+
     # Create random combinations and metadata for concatenation
-    if args.single_speaker:
-        create_random_combination_single_spk(
-            bonafide_wav_files,
-            spoof_wav_files,
-            in_data_dir + "/spk2utt",
-            in_data_dir + "/utt2dur",
-            out_data_dir,
-            num_bonafides=args.num_bonafides,
-            num_spoofs=args.num_spoofs,
-            num_bonafides_single=args.num_bonafides_single,
-            num_spoofs_single=args.num_spoofs_single,
+    create_random_combination_batch(
+        bonafide_wav_files,
+        spoof_wav_files,
+        in_data_dir + "/utt2dur",
+        out_data_dir,
+        spk2utt_file=in_data_dir + "/spk2utt" if args.single_speaker else None,
+        num_bonafides=args.num_bonafides,
+        num_spoofs=args.num_spoofs,
+        num_bonafides_single=args.num_bonafides_single,
+        num_spoofs_single=args.num_spoofs_single,
+        seed=seed,
+    )
+
+    # Optionally decode the whole input corpus once into shared memory
+    cache = None
+    if args.cache_memory_mb > 0:
+        cache = CorpusCache.build(
+            in_data_df["file"].tolist(),
+            args.cache_memory_mb * 1024 * 1024,
+            backend=args.cache_backend,
+            mmap_path=out_data_dir + "/corpus_cache.int16",
         )
-    else:
-        create_random_combination(
-            bonafide_wav_files,
-            spoof_wav_files,
-            in_data_dir + "/utt2dur",
+        if cache is None:
+            print("Corpus does not fit in the cache budget, reading wavs from disk")
+        else:
+            print(
+                "Decoded {} wav files ({} MB) into the corpus cache".format(
+                    len(cache), cache.nbytes // (1024 * 1024)
+                )
+            )
+
+    # Perform concatenation according to generated metadata
+    try:
+        concatenation(
+            in_data_dir,
             out_data_dir,
-            num_bonafides=args.num_bonafides,
-            num_spoofs=args.num_spoofs,
-            num_bonafides_single=args.num_bonafides_single,
-            num_spoofs_single=args.num_spoofs_single,
+            in_data_df,
+            args.num_bonafides_single,
+            args.num_spoofs_single,
+            single_speaker=args.single_speaker,
+            cache=cache,
+            num_workers=args.num_workers,
+            seed=seed,
         )
-    # Perform concatenation according to generated metadata
-    concatenation(
-        in_data_dir,
-        out_data_dir,
-        in_data_df,
-        args.num_bonafides_single,
-        args.num_spoofs_single,
-        single_speaker=args.single_speaker,
-    )
+    finally:
+        if cache is not None:
+            cache.close()
+
+
+# Simple unit test: the outputs must not depend on the number of workers
+def unit_test():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        rng = np.random.default_rng(0)
+        wav_files = write_toy_data_dir(tmp_dir + "/in", rng)
+        in_data_df = pd.DataFrame(columns=["file", "label", "speaker", "attack"])
+
+        out_files = {}
+        for num_workers in [1, 3]:
+            out_data_dir = tmp_dir + "/out_{}".format(num_workers)
+            os.makedirs(out_data_dir + "/wavs")
+            create_random_combination_batch(
+                wav_files[:15],
+                wav_files[15:],
+                tmp_dir + "/in/utt2dur",
+                out_data_dir,
+                num_bonafides=4,
+                num_spoofs=8,
+                seed=0,
+            )
+            concatenation(
+                tmp_dir + "/in",
+                out_data_dir,
+                in_data_df,
+                3,
+                7,
+                num_workers=num_workers,
+                chunk_size=2,
+            )
+            out_files[num_workers] = {}
+            for name in ["data.csv", "asvspoof2019_trials.txt"] + [
+                "wavs/" + w for w in sorted(os.listdir(out_data_dir + "/wavs"))
+            ]:
+                with open(out_data_dir + "/" + name, "rb") as f:
+                    content = f.read()
+                if name == "data.csv":
+                    content = content.replace(b"out_3", b"out_1")
+                out_files[num_workers][name] = content
+
+        assert out_files[1] == out_files[3], "outputs differ with num_workers"
+        print("Concatenation outputs are identical with 1 and 3 workers")
+
+        # Crash after 5 files: the wavs of the others are gone, and the
+        # last line of the journal is cut
+        out_data_dir = tmp_dir + "/out_1"
+        with open(out_data_dir + "/journal_concat.jsonl", "r") as f:
+            lines = f.readlines()
+        with open(out_data_dir + "/journal_concat.jsonl", "w") as f:
+            f.writelines(lines[:5])
+            f.write(lines[5][:20])
+        for line in lines[5:]:
+            os.remove(out_data_dir + "/wavs/{}.wav".format(json.loads(line)["key"]))
+        concatenation(
+            tmp_dir + "/in", out_data_dir, in_data_df, 3, 7, num_workers=3, chunk_size=2
+        )
+        for name, content in out_files[1].items():
+            with open(out_data_dir + "/" + name, "rb") as f:
+                assert f.read() == content, name
+        print("Resumed concatenation gives identical outputs")
+    finally:
+        shutil.rmtree(tmp_dir)
 
 
 if __name__ == "__main__":
+    # unit_test()
     main()
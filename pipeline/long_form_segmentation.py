@@ -1,102 +1,346 @@
 """
 Perform segmentation on the waveforms with given segmentation
 length, in order to perform experiments on duration
+
+The long-form wavs at the target sample rate are read one segment at a
+time, and each segment is written as soon as it is read, so the memory
+does not depend on the duration of the long-form files.
+
+--segment_length takes a comma-separated list of lengths, e.g. 1,2,4,8,
+with --out_data_dir containing {} for the length, e.g. p3/SEG{}. Every
+long-form file is then read once, and cut into the segments of all the
+lengths as it is read.
+
+With --hop_length, the segments are overlapping windows starting every
+hop, e.g. 4 s windows every 1 s, the last one being shorter when the
+windows do not end with the file. The windows are strided views of the
+samples read, written without copying them, and their spoof proportions
+are computed on their own sample intervals.
+
+With --index_only, no audio is written: out_data_dir/segment_index.txt
+lists the long-form wav, start and end samples and labels of every
+segment, to be read with utils/segment_index.py:SegmentReader. Only the
+headers of the long-form wavs are read.
+
+Resumable after a crash, see utils/journal.py.
 """
 
 import argparse
 import os
 import sys
 
+import numpy as np
 import pandas as pd
 import soundfile as sf
-import librosa
 
+from utils.audio_io import load_audio
+from utils.journal import Journal, atomic_output
+from utils.segment_index import write_segment_index
 
-def re_segmentation(
-    src_id,
-    src_wav_path,
-    durations,
-    labels,
-    out_wav_dir,
-    segment_length_seconds=4,
-    decision="spoof",
-    samplerate=16000,
-):
-    os.makedirs(out_wav_dir, exist_ok=True)
 
-    concatenated_audio, _ = librosa.load(src_wav_path, sr=samplerate)
+# Write one segment, under a temporary name renamed once it is complete
+def write_segment(segment_id, segment_audio, out_wav_dir, samplerate=16000):
+    segment_path = os.path.join(out_wav_dir, f"{segment_id}.wav")
+    with atomic_output(segment_path) as tmp_path:
+        sf.write(tmp_path, segment_audio, samplerate)
+
 
-    # Segment the concatenated audio into chunks
-    segment_samples = int(segment_length_seconds * samplerate)
-    total_samples = len(concatenated_audio)
+# Number of segments of segment_samples every hop_samples in total_samples,
+# the last one ending with the file
+def num_segments(total_samples, segment_samples, hop_samples):
+    if total_samples <= 0:
+        return 0
+    return 1 + max(0, -(-(total_samples - segment_samples) // hop_samples))
 
-    start_idx = 0
-    segment_idx = 1
-    segment_metadata = []
 
-    while start_idx < total_samples:
-        end_idx = min(start_idx + segment_samples, total_samples)
-        segment_audio = concatenated_audio[start_idx:end_idx]
+# Paths of the segment wavs of a file of total_samples
+def segment_paths(
+    src_id, out_wav_dir, total_samples, segment_samples, hop_samples=None
+):
+    if hop_samples is None:
+        hop_samples = segment_samples
+    return [
+        os.path.join(out_wav_dir, f"{src_id}_{i + 1}.wav")
+        for i in range(num_segments(total_samples, segment_samples, hop_samples))
+    ]
+
+
+# Start and end samples of the segments of a file of total_samples
+def segment_bounds(total_samples, segment_samples, hop_samples=None):
+    if hop_samples is None:
+        hop_samples = segment_samples
+    starts = hop_samples * np.arange(
+        num_segments(total_samples, segment_samples, hop_samples), dtype=np.int64
+    )
+    return starts, np.minimum(starts + segment_samples, total_samples)
 
-        # Save the segmented audio
-        segment_id = (
-            f"{os.path.splitext(os.path.basename(src_wav_path))[0]}_{segment_idx}"
+
+# Cut a long-form waveform into segments and write them
+def write_segments(
+    src_id,
+    audio,
+    out_wav_dir,
+    segment_length_seconds=4,
+    samplerate=16000,
+    hop_length_seconds=None,
+):
+    """
+    Write the segments of a waveform as <src_id>_<N>.wav, one every
+    hop_length_seconds (segment_length_seconds by default), the last one
+    being shorter. Returns (segment_id, start, end) of every segment.
+    """
+    writer = SegmentWriter(
+        src_id,
+        out_wav_dir,
+        int(segment_length_seconds * samplerate),
+        samplerate,
+        hop_samples=(
+            None if hop_length_seconds is None else int(hop_length_seconds * samplerate)
+        ),
+    )
+    writer.feed(audio)
+    return writer.close()
+
+
+# Cuts the blocks of a waveform fed to it into segments, and writes them
+class SegmentWriter(object):
+    def __init__(
+        self, src_id, out_wav_dir, segment_samples, samplerate=16000, hop_samples=None
+    ):
+        """
+        Segments of segment_samples starting every hop_samples, at most
+        segment_samples (the default, for non-overlapping segments)
+        """
+        if hop_samples is None:
+            hop_samples = segment_samples
+        assert 0 < hop_samples <= segment_samples, "hop longer than the segments"
+        self.src_id = src_id
+        self.out_wav_dir = out_wav_dir
+        self.samplerate = samplerate
+        self.segment_samples = segment_samples
+        self.hop_samples = hop_samples
+        # Samples from the start of the next segment, allocated with the
+        # dtype of the first block
+        self.buffer = None
+        self.fill = 0
+        self.start = 0
+        # (segment_id, start, end) of the segments written
+        self.segment_metadata = []
+        os.makedirs(out_wav_dir, exist_ok=True)
+
+    def write(self, segment_audio):
+        segment_id = f"{self.src_id}_{len(self.segment_metadata) + 1}"
+        write_segment(segment_id, segment_audio, self.out_wav_dir, self.samplerate)
+        self.segment_metadata.append(
+            (segment_id, self.start, self.start + len(segment_audio))
+        )
+        self.start += self.hop_samples
+
+    def feed(self, block):
+        if self.buffer is None:
+            self.buffer = np.empty(2 * self.segment_samples, dtype=block.dtype)
+        while len(block) > 0:
+            if self.fill == 0:
+                # The segments are cut from the block itself
+                data, block = block, block[:0]
+            else:
+                n = min(len(block), len(self.buffer) - self.fill)
+                self.buffer[self.fill : self.fill + n] = block[:n]
+                self.fill += n
+                block = block[n:]
+                data = self.buffer[: self.fill]
+
+            if len(data) >= self.segment_samples:
+                # All the whole segments, as strided views of the samples
+                windows = np.lib.stride_tricks.sliding_window_view(
+                    data, self.segment_samples
+                )[:: self.hop_samples]
+                for segment_audio in windows:
+                    self.write(segment_audio)
+                data = data[len(windows) * self.hop_samples :]
+            # The samples of the next segments, shorter than a segment
+            self.buffer[: len(data)] = data
+            self.fill = len(data)
+
+    def close(self):
+        # The last segment is shorter, when the previous one did not end
+        # with the file
+        if self.fill > 0 and (
+            not self.segment_metadata
+            or self.fill > self.segment_samples - self.hop_samples
+        ):
+            self.write(self.buffer[: self.fill])
+        self.fill = 0
+        return self.segment_metadata
+
+
+# Cut a long-form wav file into segments of one or more lengths, with a
+# single read of the file
+def stream_segments(
+    src_id,
+    src_wav_path,
+    out_wav_dirs,
+    segment_lengths_seconds,
+    samplerate=16000,
+    hop_lengths_seconds=None,
+):
+    """
+    Write the same segments as write_segments on the decoded file, for
+    every (output directory, segment length, hop length), with one block
+    of the longest segment length in memory. Files that need resampling
+    or downmixing are decoded whole. Returns the (segment_id, start, end)
+    of the segments of every length.
+    """
+    if hop_lengths_seconds is None:
+        hop_lengths_seconds = [None] * len(segment_lengths_seconds)
+    with sf.SoundFile(src_wav_path) as f:
+        if f.samplerate != samplerate or f.channels != 1:
+            audio, _ = load_audio(src_wav_path, sr=samplerate)
+            return [
+                write_segments(
+                    src_id,
+                    audio,
+                    out_wav_dir,
+                    segment_length_seconds=segment_length_seconds,
+                    samplerate=samplerate,
+                    hop_length_seconds=hop_length_seconds,
+                )
+                for out_wav_dir, segment_length_seconds, hop_length_seconds in zip(
+                    out_wav_dirs, segment_lengths_seconds, hop_lengths_seconds
+                )
+            ]
+
+        writers = [
+            SegmentWriter(
+                src_id,
+                out_wav_dir,
+                int(segment_length_seconds * samplerate),
+                samplerate,
+                hop_samples=(
+                    None
+                    if hop_length_seconds is None
+                    else int(hop_length_seconds * samplerate)
+                ),
+            )
+            for out_wav_dir, segment_length_seconds, hop_length_seconds in zip(
+                out_wav_dirs, segment_lengths_seconds, hop_lengths_seconds
+            )
+        ]
+        buffer = np.empty(max(w.segment_samples for w in writers), dtype=np.float32)
+        while True:
+            # A view of the buffer, shorter at the end of the file
+            block = f.read(len(buffer), dtype="float32", out=buffer)
+            if len(block) == 0:
+                break
+            for writer in writers:
+                writer.feed(block)
+    return [writer.close() for writer in writers]
+
+
+# Number of samples of every part of a long-form file
+def part_samples(src_id, wav_paths, total_samples=None, samplerate=16000):
+    """
+    The lengths that the concatenation wrote, from the headers of the
+    part wavs. A part whose wav does not exist was left out of the
+    concatenation, and has no samples.
+    total_samples: length of the long-form file, that the parts must add
+        up to, e.g. not if a part wav was removed since the concatenation
+    """
+    samples = np.zeros(len(wav_paths), dtype=np.int64)
+    for i, wav_path in enumerate(wav_paths):
+        if os.path.exists(wav_path):
+            info = sf.info(wav_path)
+            samples[i] = -(-info.frames * samplerate // info.samplerate)
+    if total_samples is not None and samples.sum() != total_samples:
+        raise ValueError(
+            "The parts of {} add up to {} samples, but it has {}: were its "
+            "part wavs changed since the concatenation?".format(
+                src_id, samples.sum(), total_samples
+            )
         )
-        segment_path = os.path.join(out_wav_dir, f"{segment_id}.wav")
-        sf.write(segment_path, segment_audio, samplerate)
-        print(segment_path)
+    return samples
 
-        # Store the segment for further processing
-        segment_metadata.append((segment_id, start_idx, end_idx))
 
-        # Update indices for the next chunk
-        start_idx = end_idx
-        segment_idx += 1
+# Calculate the spoof ratio of the segments from the sample boundaries
+# of the parts
+def label_segments(
+    src_id, samples, labels, segment_samples, total_samples=None, hop_samples=None
+):
+    """
+    samples, labels: number of samples and label (b or s) of every part
+    segment_samples: length of the segments, the last one being shorter
+    total_samples: length of the long-form file, the sum of the parts by
+        default, so that every segment written gets a label
+    hop_samples: distance between the starts of the segments,
+        segment_samples by default
+
+    Returns the "<segment_id> <spoof proportion> <decision>" metadata and
+    the trials of the segments, as the spoof samples over the samples of
+    each segment.
+    """
+    samples = np.asarray(samples, dtype=np.int64)
+    spoof = np.asarray(labels) == "s"
+    ends = np.cumsum(samples)
+    if total_samples is None:
+        total_samples = int(ends[-1]) if len(ends) > 0 else 0
+    # Spoof samples before every part
+    spoof_before = np.concatenate([[0], np.cumsum(samples * spoof)])
+
+    starts, stops = segment_bounds(total_samples, segment_samples, hop_samples)
+
+    # Spoof samples in [0, t), from the part that sample t is in
+    def spoof_until(t):
+        part = np.searchsorted(ends, t, side="right")
+        if len(samples) == 0:
+            return np.zeros_like(t)
+        inside = np.minimum(part, len(samples) - 1)
+        offset = t - (ends[inside] - samples[inside])
+        return spoof_before[part] + np.where(
+            (part < len(samples)) & spoof[inside], offset, 0
+        )
 
-    # Step 2: Calculate spoof ratios and generate metadata
-    segment_durations = [float(dur) for dur in durations.split(",")]
-    segment_labels = labels.split(",")
+    portions = (spoof_until(stops) - spoof_until(starts)) / (stops - starts)
 
     metadata = []
     segmented_trials_metadata = []
-    current_chunk = []
-    current_time = 0.0
-
-    for duration, label in zip(segment_durations, segment_labels):
-        while duration > 0:
-            remaining_time = segment_length_seconds - current_time
-
-            if duration >= remaining_time:
-                # Add the remaining part to fill the current chunk
-                current_chunk.append((remaining_time, label))
-                duration -= remaining_time
-                current_time = segment_length_seconds
-            else:
-                # Add the whole duration to the current chunk
-                current_chunk.append((duration, label))
-                current_time += duration
-                duration = 0
-
-            # If a chunk is complete
-            if current_time >= segment_length_seconds:
-                # Calculate the portion of 's' in the chunk
-                portion_s = (
-                    sum(d for d, l in current_chunk if l == "s")
-                    / segment_length_seconds
-                )
+    for i, portion_s in enumerate(portions.tolist()):
+        segment_id = f"{src_id}_{i + 1}"
+        decision = "spoof" if portion_s > 0.0 else "bonafide"
+        metadata.append(f"{segment_id} {portion_s} {decision}")
+        segmented_trials_metadata.append(f"{segment_id} {segment_id} - - {decision}")
 
-                decision = "spoof" if portion_s > 0.0 else "bonafide"
+    return metadata, segmented_trials_metadata
 
-                metadata.append(f"{src_id}_{len(metadata) + 1} {portion_s} {decision}")
-                segmented_trials_metadata.append(
-                    f"{src_id}_{len(metadata) + 1} {src_id}_{len(metadata) + 1} - - {decision}"
-                )
 
-                # Reset for the next chunk
-                current_chunk = []
-                current_time = 0.0
+# Write the metadata, trials and data.csv of the segments
+def write_segment_manifests(out_data_dir, segmentations, columns, data_csv=True):
+    """
+    segmentations: (metadata, segmented_trials_metadata) of every
+    long-form file, as returned by label_segments
+    data_csv: whether to write data.csv, which lists the segment wavs
+    """
+    out_segment_file = out_data_dir + "/segment_comb_metadata.txt"
+    out_segment_wavs_dir = out_data_dir + "/wavs"
+    out_segment_trials_file = out_data_dir + "/asvspoof2019_trials.txt"
 
-    return metadata, segmented_trials_metadata
+    rows = []
+    with open(out_segment_file, "w") as t, open(out_segment_trials_file, "w") as tr:
+        for metadata, segmented_trials_metadata in segmentations:
+            t.write("\n".join(metadata) + "\n")
+            tr.write("\n".join(segmented_trials_metadata) + "\n")
+            for item in metadata:
+                utt_id, _, decision = item.split()
+                wav_path = out_segment_wavs_dir + "/{}.wav".format(utt_id)
+                rows.append([wav_path, decision, "segment_spk", "longform"])
+
+    if not data_csv:
+        return
+
+    # Write the dataframe
+    out_data_df = pd.DataFrame(rows, columns=columns)
+    out_data_csv = out_data_dir + "/data.csv"
+    with atomic_output(out_data_csv) as tmp_path:
+        out_data_df.to_csv(tmp_path)
 
 
 def main():
@@ -108,69 +352,197 @@ def main():
     parser.add_argument(
         "--out_data_dir", type=str, help="Output data directory", required=True
     )
-    parser.add_argument("--segment_length", type=float, default=4.0)
+    # One or more comma-separated lengths, in seconds
+    parser.add_argument("--segment_length", type=str, default="4.0")
+    # Distance between the starts of overlapping segments, in seconds,
+    # one for all the lengths or one per length; non-overlapping if not given
+    parser.add_argument("--hop_length", type=str, default=None)
+    # Write the index of the segments into the long-form wavs, no audio
+    parser.add_argument("--index_only", action="store_true")
 
     args = parser.parse_args()
 
     in_data_dir = args.in_data_dir
-    out_data_dir = args.out_data_dir
     for i in ["data.csv", "wavs"]:
         assert os.path.exists(in_data_dir + "/" + i)
 
-    os.makedirs(out_data_dir + "/wavs", exist_ok=True)
-
-    segment_length_seconds = args.segment_length
+    # One output directory per segment length, named as given
+    segment_lengths = args.segment_length.split(",")
+    if len(segment_lengths) > 1 and "{}" not in args.out_data_dir:
+        sys.exit("--out_data_dir needs {} for the length with several lengths")
+    out_data_dirs = [args.out_data_dir.format(length) for length in segment_lengths]
+    segment_lengths_seconds = [float(length) for length in segment_lengths]
+    if args.hop_length is None:
+        hop_lengths_seconds = [None] * len(segment_lengths)
+    else:
+        hop_lengths_seconds = [float(hop) for hop in args.hop_length.split(",")]
+        if len(hop_lengths_seconds) == 1:
+            hop_lengths_seconds *= len(segment_lengths)
+        if len(hop_lengths_seconds) != len(segment_lengths) or any(
+            not 0 < hop <= length
+            for hop, length in zip(hop_lengths_seconds, segment_lengths_seconds)
+        ):
+            sys.exit("--hop_length needs one hop, or one per length, up to the length")
+    for out_data_dir in out_data_dirs:
+        os.makedirs(
+            out_data_dir if args.index_only else out_data_dir + "/wavs", exist_ok=True
+        )
 
     # Perform noise augmention on the waveform
     # load the input dataframe first
     in_data_df = pd.read_csv(in_data_dir + "/data_sample.csv")
     in_data_df = in_data_df.drop(columns=["Unnamed: 0"])
 
-    # Create an empty DataFrame with the same columns
-    out_data_df = pd.DataFrame(columns=in_data_df.columns)
-
     # Segmentation with metadata and trial stats stored
     # read the original concatenation data for segmentation
     src_segment_file = "none"
     for filename in os.listdir(in_data_dir):
-        if "src_comb_metadata" in filename:
+        if "src_comb_metadata" in filename and filename.endswith(".txt"):
             src_segment_file = in_data_dir + "/" + filename
     if src_segment_file == "none":
         sys.exit("Please check the original directory for the src_comb_metadata.txt")
     src_concat_wavs_dir = in_data_dir + "/wavs"
-    out_segment_file = out_data_dir + "/segment_comb_metadata.txt"
-    out_segment_wavs_dir = out_data_dir + "/wavs"
-    out_segment_trials_file = out_data_dir + "/asvspoof2019_trials.txt"
+    # Long-form files segmented by a previous run, for every length
+    journals = [
+        Journal(out_data_dir + "/journal_segmentation.jsonl")
+        for out_data_dir in out_data_dirs
+    ]
+
+    segments_samples = [int(length * 16000) for length in segment_lengths_seconds]
+    hops_samples = [
+        None if hop is None else int(hop * 16000) for hop in hop_lengths_seconds
+    ]
+
+    # Whether the segments of a file are recorded for length k, and all
+    # still there
+    def segmented(k, concat_id, src_concat_wav_path):
+        record = journals[k].get(concat_id)
+        if record is None:
+            return False
+        outputs = segment_paths(
+            concat_id,
+            out_data_dirs[k] + "/wavs",
+            record["samples"],
+            segments_samples[k],
+            hops_samples[k],
+        )
+        return journals[k].done(
+            concat_id,
+            outputs=outputs,
+            sources=[src_concat_wav_path],
+            segment_length=segment_lengths_seconds[k],
+            hop_length=hop_lengths_seconds[k],
+        )
 
-    with open(src_segment_file, "r") as s, open(out_segment_file, "w") as t, open(
-        out_segment_trials_file, "w"
-    ) as tr:
-        for line in s:
-            concat_id, _, durations, labels, decision = line.split()
-            src_concat_wav_path = src_concat_wavs_dir + "/{}.wav".format(concat_id)
-            metadata, segmented_trials_metadata = re_segmentation(
-                concat_id,
-                src_concat_wav_path,
-                durations,
-                labels,
-                out_segment_wavs_dir,
-                segment_length_seconds=segment_length_seconds,
-            )
-            t.write("\n".join(metadata) + "\n")
-            tr.write("\n".join(segmented_trials_metadata) + "\n")
-            for item in metadata:
-                utt_id, _, decision = item.split()
-                wav_path = out_segment_wavs_dir + "/{}.wav".format(utt_id)
-                out_data_df.loc[len(out_data_df)] = [
-                    wav_path,
-                    decision,
-                    "segment_spk",
-                    "longform",
+    segmentations = [[] for _ in out_data_dirs]
+    # (segment_id, long-form wav, start, end, proportion, decision) of the
+    # segments, with --index_only
+    segment_indices = [[] for _ in out_data_dirs]
+    num_resumed = 0
+    try:
+        with open(src_segment_file, "r") as s:
+            for line in s:
+                concat_id, wav_paths, _, labels, decision = line.split()
+                src_concat_wav_path = src_concat_wavs_dir + "/{}.wav".format(concat_id)
+
+                # The lengths that are still to be written for this file
+                pending = [
+                    k
+                    for k in range(len(journals))
+                    if not args.index_only
+                    and not segmented(k, concat_id, src_concat_wav_path)
                 ]
-
-    # Write the dataframe
-    out_data_csv = out_data_dir + "/data.csv"
-    out_data_df.to_csv(out_data_csv)
+                if pending:
+                    segment_metadata = stream_segments(
+                        concat_id,
+                        src_concat_wav_path,
+                        [out_data_dirs[k] + "/wavs" for k in pending],
+                        [segment_lengths_seconds[k] for k in pending],
+                        hop_lengths_seconds=[hop_lengths_seconds[k] for k in pending],
+                    )
+                    total_samples = (
+                        segment_metadata[0][-1][2] if segment_metadata[0] else 0
+                    )
+                    print(
+                        "Segmented {} ({} samples) into {} segments".format(
+                            src_concat_wav_path,
+                            total_samples,
+                            "+".join(str(len(m)) for m in segment_metadata),
+                        )
+                    )
+                    for k in pending:
+                        journals[k].record(
+                            concat_id,
+                            sources=[src_concat_wav_path],
+                            segment_length=segment_lengths_seconds[k],
+                            hop_length=hop_lengths_seconds[k],
+                            samples=total_samples,
+                        )
+                elif not args.index_only:
+                    num_resumed += 1
+
+                # Calculate spoof ratios and generate metadata, for every
+                # segment written up to the end of the file
+                if args.index_only:
+                    total_samples = sf.info(src_concat_wav_path).frames
+                else:
+                    total_samples = journals[0].get(concat_id)["samples"]
+                samples = part_samples(
+                    concat_id, wav_paths.split(","), total_samples=total_samples
+                )
+                for k in range(len(journals)):
+                    segment_samples = segments_samples[k]
+                    hop_samples = hops_samples[k]
+                    segmentations[k].append(
+                        label_segments(
+                            concat_id,
+                            samples,
+                            labels.split(","),
+                            segment_samples,
+                            total_samples=total_samples,
+                            hop_samples=hop_samples,
+                        )
+                    )
+                    if args.index_only:
+                        starts, stops = segment_bounds(
+                            total_samples, segment_samples, hop_samples
+                        )
+                        for item, start, stop in zip(
+                            segmentations[k][-1][0], starts.tolist(), stops.tolist()
+                        ):
+                            segment_id, portion_s, decision = item.split()
+                            segment_indices[k].append(
+                                (
+                                    segment_id,
+                                    src_concat_wav_path,
+                                    start,
+                                    stop,
+                                    portion_s,
+                                    decision,
+                                )
+                            )
+    finally:
+        for journal in journals:
+            journal.close()
+    if num_resumed > 0:
+        print("Resumed: {} long-form files already segmented".format(num_resumed))
+
+    for out_data_dir, segmentation, segment_index in zip(
+        out_data_dirs, segmentations, segment_indices
+    ):
+        write_segment_manifests(
+            out_data_dir,
+            segmentation,
+            in_data_df.columns,
+            data_csv=not args.index_only,
+        )
+        if args.index_only:
+            write_segment_index(out_data_dir + "/segment_index.txt", segment_index)
+            print(
+                "Wrote the index of {} segments to {}".format(
+                    len(segment_index), out_data_dir + "/segment_index.txt"
+                )
+            )
 
 
 if __name__ == "__main__":
@@ -10,7 +10,22 @@ case, the total amount of data is not augmented.
 - This is to avoid the question that "does noise work or we simply
 have more data to train?"
 
-TODO We have disabled RIR for now.
+The noise is drawn uniformly among the selected methods. Reverberation
+with the simulated RIRs ("reverb") is available, but not selected by
+default.
+
+Every utterance draws its method, noise files, offsets and SNRs from its
+own generator, seeded with the global --seed and the utterance ID. The
+output does not depend on --num_workers, and any subset of the files can
+be deleted and regenerated identically. The draws of each file are
+recorded in out_data_dir/noise_params/<utt>.json.
+
+Resumable after a crash, see utils/journal.py, with the seed of the
+journal if --seed is not given.
+
+With --block_size, the files are streamed through the noise block by
+block (see rir_musan_loader.add_noise_stream), so that long-form files of
+any duration are augmented in constant memory, with the same draws.
 """
 
 import argparse
@@ -18,117 +33,356 @@ import os
 import sys
 import random
 import glob
+import json
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import chain
 
 import numpy as np
 import pandas as pd
 import shutil
-import librosa
 import soundfile as sf
-from scipy import signal
+
+from utils.audio_io import load_audio
+from utils.journal import Journal, atomic_output
+from utils.noise_bank import NoiseBank
+from utils.noise_inventory import load_inventory
+from utils.reverb import StreamingReverb, reverberate
 
 
 MUSAN_DIR = "data/Database/musan"
 RIR_DIR = "data/Database/RIRS_NOISES/simulated_rirs"
 
+NOISE_METHODS = ["-", "reverb", "babble", "music", "noise", "babble-music"]
+DEFAULT_NOISE_METHODS = ["-", "babble", "music", "noise", "babble-music"]
+# MUSAN categories added by each method, in order
+NOISE_CATEGORIES = {
+    "babble": ["speech"],
+    "music": ["music"],
+    "noise": ["noise"],
+    "babble-music": ["speech", "music"],
+}
+
+
+# Noise file repeated from an offset, read window by window
+class NoiseWindow(object):
+    def __init__(self, source, offset=0):
+        """
+        source: int16 view of the noise in the bank, or an open SoundFile
+        """
+        self.source = source
+        self.offset = offset
+        if isinstance(source, sf.SoundFile):
+            self.num_frames = source.frames
+        else:
+            self.num_frames = len(source)
+
+    # Read samples [start, start + len(out)) of the noise file
+    def read(self, start, out):
+        if isinstance(self.source, sf.SoundFile):
+            self.source.seek(start)
+            self.source.read(out=out)
+        else:
+            out[:] = self.source[start : start + len(out)]
+            # Same values as what sf.read gives for 16-bit files
+            out *= 1 / 32768.0
+
+    # Fill out with the window samples [pos, pos + len(out))
+    def fill(self, pos, out):
+        # One period of the noise at most is read, wrapping around its end
+        period = min(self.num_frames, len(out))
+        filled = 0
+        while filled < period:
+            start = (self.offset + pos + filled) % self.num_frames
+            n = min(self.num_frames - start, period - filled)
+            self.read(start, out[filled : filled + n])
+            filled += n
+
+        # The rest is filled by doubling the periods already there
+        while filled < len(out):
+            n = min(filled, len(out) - filled)
+            out[filled : filled + n] = out[:n]
+            filled += n
+
+    # Sum of squares of the window samples [pos, pos + n), read in blocks
+    def range_sumsq(self, pos, n, block_size=65536):
+        buffer = np.zeros(min(block_size, n), dtype=np.float32)
+        total = 0.0
+        for i in range(0, n, block_size):
+            block = buffer[: min(block_size, n - i)]
+            self.fill(pos + i, block)
+            total += np.dot(block.astype(np.float64), block)
+        return total
+
+    # Sum of squares of the first length samples of the window, which
+    # holds whole periods of the noise and then a partial one
+    def sumsq(self, length, block_size=65536):
+        periods, rest = divmod(length, self.num_frames)
+        total = self.range_sumsq(0, rest, block_size)
+        if periods > 0:
+            total += periods * self.range_sumsq(0, self.num_frames, block_size)
+        return total
+
+    def close(self):
+        if isinstance(self.source, sf.SoundFile):
+            self.source.close()
+
 
 # Loader for MUSAN (noise) and RIR (reverberation) datasets
 class rir_musan_loader(object):
-    def __init__(self, musan_path, rir_path, samplerate=16000, snr_range=[0, 10]):
+    def __init__(
+        self,
+        musan_path,
+        rir_path,
+        samplerate=16000,
+        snr_range=[0, 10],
+        noise_bank_dir=None,
+        inventory_dir=None,
+        noise_methods=DEFAULT_NOISE_METHODS,
+    ):
         # Initialize noise and RIR file lists and parameters
+        for method in noise_methods:
+            if method not in NOISE_METHODS:
+                raise ValueError("Unknown noise method {}".format(method))
+        self.noise_methods = list(noise_methods)
         self.noisetypes = ["noise", "speech", "music"]
         self.noisesnr = {"noise": snr_range, "speech": snr_range, "music": snr_range}
         self.numnoise = {"noise": [1, 1], "speech": [3, 8], "music": [1, 1]}
 
+        # Sorted, so that a seeded draw picks the same files on any filesystem
+        musan_sources = None
+        if inventory_dir is not None:
+            # Cached lists without empty or corrupt files, see noise_inventory.py
+            musan_inventory = load_inventory(
+                musan_path, os.path.join(inventory_dir, "musan_inventory.txt")
+            )
+            rir_inventory = load_inventory(
+                rir_path, os.path.join(inventory_dir, "rir_inventory.txt")
+            )
+            musan_sources = [
+                (c, path, mtime) for c, path, _, _, mtime in musan_inventory
+            ]
+            augment_files = [path for _, path, _ in musan_sources]
+            self.rir_files = [path for _, path, _, _, _ in rir_inventory]
+        else:
+            augment_files = sorted(glob.glob(os.path.join(musan_path, "*/*/*.wav")))
+            self.rir_files = sorted(glob.glob(os.path.join(rir_path, "*/*/*.wav")))
+
+        self.noise_bank = None
+        if noise_bank_dir is not None:
+            # Noise is sliced from the memory-mapped bank of MUSAN
+            self.noise_bank = NoiseBank.build(
+                musan_path, noise_bank_dir, samplerate=samplerate, sources=musan_sources
+            )
+            augment_files = [path for path in augment_files if path in self.noise_bank]
+
         self.noiselist = {}
-        augment_files = glob.glob(os.path.join(musan_path, "*/*/*.wav"))
         for file in augment_files:
             noise_type = file.split("/")[-3]
             if noise_type not in self.noiselist:
                 self.noiselist[noise_type] = []
             self.noiselist[noise_type].append(file)
 
-        self.rir_files = glob.glob(os.path.join(rir_path, "*/*/*.wav"))
         self.samplerate = samplerate
 
+        # float32 buffers of the noise, grown to the longest input so far
+        self.noise_sum = np.zeros(0, dtype=np.float32)
+        self.noise_window = np.zeros(0, dtype=np.float32)
+
     # Add a random type of noise or reverberation to input audio
-    def add_noise(self, in_audio):
-        noise_methods = ["-", "reverb", "babble", "music", "noise", "telnoise"]
-        random_index = random.randint(0, 4)
-
-        if random_index == 0:  # No augmentation
-            audio = in_audio
-        # elif random_index == 1:  # Reverberation (currently disabled)
-        # audio = self.add_rev_single(in_audio)
-        # audio = in_audio
-        elif random_index == 1:  # Add babble noise (speech)
-            audio = self.add_noise_single(in_audio, "speech")
-        elif random_index == 2:  # Add music noise
-            audio = self.add_noise_single(in_audio, "music")
-        elif random_index == 3:  # Add generic noise
-            audio = self.add_noise_single(in_audio, "noise")
-        elif random_index == 4:  # Add both speech and music
-            audio = self.add_noise_single(in_audio, "speech")
-            audio = self.add_noise_single(audio, "music")
-
-        return audio, noise_methods[random_index]
-
-    # Apply reverberation using a random RIR file (not used in this script)
-    def add_rev_single(self, audio):
+    def add_noise(self, in_audio, rng=random, params=None):
+        """
+        rng: source of all the random draws, the global random module by
+            default, or the random.Random of the utterance
+        params: dict filled with the method, noise files, offsets, SNRs
+            and RIR that were drawn
+        """
+        method = self.draw_method(rng, params)
+
+        # The SNR of every noise is relative to the clean speech
+        rms_audio = speech_rms(in_audio)
+
+        audio = in_audio
+        if method == "reverb":  # Reverberation
+            audio = self.add_rev_single(audio, rng, params)
+        for noisecat in NOISE_CATEGORIES.get(method, []):
+            audio = self.add_noise_single(audio, noisecat, rms_audio, rng, params)
+        return audio, method
+
+    # Draw the noise method, "-" for no augmentation
+    def draw_method(self, rng=random, params=None):
+        method = self.noise_methods[rng.randint(0, len(self.noise_methods) - 1)]
+        if params is not None:
+            params["method"] = method
+            params["noises"] = []
+        return method
+
+    # Draw a RIR file, None if there are none
+    def draw_rir(self, rng=random, params=None):
         if len(self.rir_files) == 0:
+            return None
+        rir_file = rng.choice(self.rir_files)
+        if params is not None:
+            params["rir"] = rir_file
+        return rir_file
+
+    # Apply reverberation using a random RIR file, see utils/reverb.py
+    def add_rev_single(self, audio, rng=random, params=None):
+        rir_file = self.draw_rir(rng, params)
+        if rir_file is None:
             return audio  # Skip if no RIR files available
-        rir_file = random.choice(self.rir_files)
-        rir, sr = sf.read(rir_file)
-        rir = np.expand_dims(rir.astype(np.float64), 0)
-        rir = rir / np.sqrt(np.sum(rir**2) + 1e-8)  # Avoid divide-by-zero
-        rir = np.squeeze(rir)
-        return signal.convolve(audio, rir, mode="full")[: len(audio)]  # Maintain length
-
-    # Add a single type of noise (speech, music, noise) to the audio
-    def add_noise_single(self, audio, noisecat):
+        # The output keeps the length of the input
+        return reverberate(audio, rir_file, self.samplerate)
+
+    # Draw the noises of a category to mix num_samples of speech with, with
+    # their offsets and SNRs, and open windows of them
+    def draw_noise_windows(self, noisecat, num_samples, rng=random, params=None):
+        """
+        Returns a list of (NoiseWindow, SNR in dB), read from the bank or
+        from the wav files
+        """
         if noisecat not in self.noiselist or len(self.noiselist[noisecat]) == 0:
-            return audio  # Skip if no noise files
+            return []  # Skip if no noise files
+        if num_samples == 0:
+            return []
 
         numnoise = self.numnoise[noisecat]
-        noiselist = random.sample(
-            self.noiselist[noisecat], random.randint(numnoise[0], numnoise[1])
+        noiselist = rng.sample(
+            self.noiselist[noisecat], rng.randint(numnoise[0], numnoise[1])
         )
 
+        windows = []
         for noise in noiselist:
-            noiseaudio, sr = sf.read(noise)
-            if len(noiseaudio) == 0:
+            if self.noise_bank is not None:
+                window = NoiseWindow(self.noise_bank.get(noise))
+            else:
+                window = NoiseWindow(sf.SoundFile(noise))
+            if window.num_frames == 0:
+                window.close()
                 continue  # Skip empty files
+            window.offset = rng.randrange(window.num_frames)
 
-            # Ensure noise matches length of audio
-            if len(noiseaudio) < len(audio):
-                noiseaudio = np.tile(
-                    noiseaudio, int(np.ceil(len(audio) / len(noiseaudio)))
+            snr_range = self.noisesnr[noisecat]
+            snr_db = rng.uniform(snr_range[0], snr_range[1])
+            if params is not None:
+                params["noises"].append(
+                    {"file": noise, "offset": window.offset, "snr_db": snr_db}
                 )
-            noiseaudio = noiseaudio[: len(audio)]
-
-            # Calculate RMS
-            rms_audio = np.sqrt(np.mean(audio**2) + 1e-8)
-            rms_noise = np.sqrt(np.mean(noiseaudio**2) + 1e-8)
+            windows.append((window, snr_db))
+        return windows
 
-            # SNR Control
-            snr_range = self.noisesnr[noisecat]
-            snr_db = random.uniform(snr_range[0], snr_range[1])
+    # Add a single type of noise (speech, music, noise) to the audio
+    def add_noise_single(
+        self, audio, noisecat, rms_audio=None, rng=random, params=None
+    ):
+        windows = self.draw_noise_windows(noisecat, len(audio), rng, params)
+        if len(windows) == 0:
+            return audio
+
+        if rms_audio is None:
+            rms_audio = speech_rms(audio)
+        if len(self.noise_sum) < len(audio):
+            self.noise_sum = np.zeros(len(audio), dtype=np.float32)
+            self.noise_window = np.zeros(len(audio), dtype=np.float32)
+        noise_sum = self.noise_sum[: len(audio)]
+        noiseaudio = self.noise_window[: len(audio)]
+        noise_sum.fill(0.0)
+
+        # All the sources (several for babble) are scaled in place and
+        # summed into one accumulator, which is added to the audio once
+        for window, snr_db in windows:
+            window.fill(0, noiseaudio)
+            window.close()
 
-            snr_linear = 10 ** (snr_db / 20)
-            desired_rms_noise = rms_audio / snr_linear
+            # Calculate RMS
+            rms_noise = np.sqrt(np.dot(noiseaudio, noiseaudio) / len(noiseaudio) + 1e-8)
 
             # Scale noise to match target SNR
-            scaled_noise = noiseaudio * (desired_rms_noise / rms_noise)
-
-            # Add noise to audio
-            audio = audio + scaled_noise
-        return audio
+            desired_rms_noise = rms_audio / 10 ** (snr_db / 20)
+            noiseaudio *= desired_rms_noise / rms_noise
+            noise_sum += noiseaudio
+
+        # Add noise to audio
+        return audio + noise_sum
+
+    # Same draws and mixing as add_noise, streamed from in_path to out_path
+    def add_noise_stream(
+        self, in_path, out_path, rng=random, params=None, block_size=65536
+    ):
+        """
+        The input is read twice in blocks of block_size samples: once for
+        the RMS of the speech, then to mix it with the noise windows and
+        write it. The memory does not grow with the duration of the input.
+        Returns the noise method.
+        """
+        with sf.SoundFile(in_path) as f:
+            num_samples = f.frames
+            sumsq = 0.0
+            for block in f.blocks(blocksize=block_size, dtype="float32"):
+                sumsq += np.dot(block.astype(np.float64), block)
+            rms_audio = np.sqrt(sumsq / num_samples + 1e-8) if num_samples > 0 else 0.0
+
+            method = self.draw_method(rng, params)
+            reverb = None
+            if method == "reverb":
+                rir_file = self.draw_rir(rng, params)
+                if rir_file is not None:
+                    reverb = StreamingReverb(rir_file, self.samplerate)
+
+            # One group of windows per category, added in the order of
+            # add_noise, with the gains of their SNRs
+            groups = []
+            for noisecat in NOISE_CATEGORIES.get(method, []):
+                windows = []
+                for window, snr_db in self.draw_noise_windows(
+                    noisecat, num_samples, rng, params
+                ):
+                    # RMS of the whole window, without reading it all at once
+                    rms_noise = np.sqrt(
+                        window.sumsq(num_samples, block_size) / num_samples + 1e-8
+                    )
+                    desired_rms_noise = rms_audio / 10 ** (snr_db / 20)
+                    windows.append((window, np.float32(desired_rms_noise / rms_noise)))
+                groups.append(windows)
+
+            noise_sum = np.zeros(block_size, dtype=np.float32)
+            noise_window = np.zeros(block_size, dtype=np.float32)
+            f.seek(0)
+            with sf.SoundFile(out_path, "w", f.samplerate, channels=1) as out:
+                pos = 0
+                for block in f.blocks(blocksize=block_size, dtype="float32"):
+                    if reverb is not None:
+                        block = reverb.process(block)
+                    for windows in groups:
+                        noise_block = noise_sum[: len(block)]
+                        noiseaudio = noise_window[: len(block)]
+                        noise_block.fill(0.0)
+                        for window, gain in windows:
+                            window.fill(pos, noiseaudio)
+                            noiseaudio *= gain
+                            noise_block += noiseaudio
+                        block = block + noise_block
+                    out.write(block)
+                    pos += len(block)
+
+        for windows in groups:
+            for window, _ in windows:
+                window.close()
+        return method
+
+
+# RMS of the speech, the reference of the SNR
+def speech_rms(audio):
+    if len(audio) == 0:
+        return 0.0
+    return np.sqrt(np.dot(audio, audio) / len(audio) + 1e-8)
 
 
 # Simple unit test for the augmentation process
 def unit_test():
     mock_loader = rir_musan_loader(MUSAN_DIR, RIR_DIR)
 
-    audio, sr = librosa.load(sys.argv[1], sr=16000)
+    audio, sr = load_audio(sys.argv[1], sr=16000)
 
     # Apply augmentation
     augmented_audio, method = mock_loader.add_noise(audio)
@@ -144,12 +398,76 @@ def unit_test():
     print("Augmented audio saved as 'test.wav'.")
 
 
+# Random generator of the noise draws of an utterance, so that they only
+# depend on the global seed and the utterance ID, not on the processing order
+def utterance_rng(seed, utt_id):
+    return random.Random("{}-{}".format(seed, utt_id))
+
+
 # Wrapper for augmentation function (for external use)
 def rir_musan_augmentation(augmenter, waveform):
     augmented_waveform, noise_type = augmenter.add_noise(waveform)
     return augmented_waveform, noise_type
 
 
+# Add noise to an int16 long-form waveform, scaled to float32 the way the
+# noise stage reads the p2 wav of the same file
+def add_noise_pcm16(augmenter, audio, rng=random, params=None):
+    return augmenter.add_noise(audio / np.float32(32768.0), rng=rng, params=params)
+
+
+# Noise augmenter of the current (worker) process
+noise_loader = None
+
+
+def init_noise_loader(loader_kwargs):
+    global noise_loader
+    noise_loader = rir_musan_loader(MUSAN_DIR, RIR_DIR, **loader_kwargs)
+
+
+# Write the parameters drawn for an utterance next to its wav
+def write_params(params_file, params):
+    with atomic_output(params_file) as tmp_path:
+        with open(tmp_path, "w") as f:
+            json.dump(params, f)
+
+
+# Augment one utterance with its own generator, and return what was drawn
+def augment_file(
+    in_file_path, noise_file_path, params_file, seed, snr_range, block_size=0
+):
+    utt_id = os.path.splitext(os.path.basename(noise_file_path))[0]
+    params = {"utt": utt_id, "seed": seed, "snr_range": snr_range}
+    rng = utterance_rng(seed, utt_id)
+    info = sf.info(in_file_path)
+    with atomic_output(noise_file_path) as tmp_path:
+        if block_size > 0 and info.samplerate == 16000 and info.channels == 1:
+            # Long-form files are streamed, in constant memory
+            noise_loader.add_noise_stream(
+                in_file_path, tmp_path, rng=rng, params=params, block_size=block_size
+            )
+            params["samples"] = info.frames
+        else:
+            input_audio, sr = load_audio(in_file_path, sr=16000)
+            input_audio, _ = noise_loader.add_noise(input_audio, rng=rng, params=params)
+            sf.write(tmp_path, input_audio, sr)
+            params["samples"] = len(input_audio)
+    write_params(params_file, params)
+    return params
+
+
+# Augment a chunk of (index, input wav, output wav, sidecar) jobs, and
+# return the (index, parameters) of each output
+def noise_augmentation_chunk(jobs, seed, snr_range, block_size=0):
+    return [
+        (
+            index,
+            augment_file(in_path, out_path, params_file, seed, snr_range, block_size),
+        )
+        for index, in_path, out_path, params_file in jobs
+    ]
+
+
 # Main function: process a directory of wavs with augmentation
 def main():
     parser = argparse.ArgumentParser()
@@ -161,6 +479,28 @@ def main():
         "--out_data_dir", type=str, help="Output data directory", required=True
     )
     parser.add_argument("--snr_range", type=str, required=True)
+    # Seed of the noise draws, random (and printed) if not given
+    parser.add_argument("--seed", type=int, default=None)
+    # Directory of the memory-mapped MUSAN bank, built on first use
+    parser.add_argument("--noise_bank_dir", type=str, default=None)
+    # Directory of the cached MUSAN/RIR inventories, built on first use
+    parser.add_argument("--inventory_dir", type=str, default=None)
+    # Comma-separated noise methods to draw from, add reverb to enable it
+    parser.add_argument(
+        "--noise_methods",
+        type=str,
+        default=",".join(DEFAULT_NOISE_METHODS),
+        help="Comma-separated methods, passed as --noise_methods=-,reverb,...",
+    )
+    parser.add_argument(
+        "--num_workers", type=int, default=1, help="Number of worker processes"
+    )
+    parser.add_argument(
+        "--chunk_size", type=int, default=16, help="Number of files per worker job"
+    )
+    # Stream the files in blocks of this many samples (e.g. for long-form
+    # files), instead of loading them whole
+    parser.add_argument("--block_size", type=int, default=0)
 
     args = parser.parse_args()
 
@@ -170,40 +510,126 @@ def main():
         assert os.path.exists(in_data_dir + "/" + i)
 
     os.makedirs(out_data_dir + "/wavs", exist_ok=True)
+    # One json per output wav, with the parameters drawn for it
+    os.makedirs(out_data_dir + "/noise_params", exist_ok=True)
+
+    # Outputs completed by a previous run of the stage
+    journal = Journal(out_data_dir + "/journal_noise.jsonl")
+
+    # Every utterance draws from a generator seeded with (seed, utterance),
+    # so the files do not depend on the number of workers, and any subset
+    # of them can be regenerated with the same seed
+    seed = args.seed
+    if seed is None and journal.last("seed") is not None:
+        seed = journal.last("seed")
+        print("No --seed given, resuming with the noise seed {}".format(seed))
+    elif seed is None:
+        seed = random.SystemRandom().randrange(2**32)
+        print("No --seed given, noise seed {}".format(seed))
 
     # initialize the noise augmenter, with controllable SNR
     snr_range = [int(i) for i in args.snr_range.split("_")]
-    noise_loader = rir_musan_loader(MUSAN_DIR, RIR_DIR, snr_range=snr_range)
+    loader_kwargs = dict(
+        snr_range=snr_range,
+        noise_bank_dir=args.noise_bank_dir,
+        inventory_dir=args.inventory_dir,
+        noise_methods=args.noise_methods.split(","),
+    )
 
     # Perform noise augmention on the waveform
     # load the input dataframe first
     in_data_df = pd.read_csv(in_data_dir + "/data.csv")
     in_data_df = in_data_df.drop(columns=["Unnamed: 0"])
 
-    # Create an empty DataFrame with the same columns
-    out_data_df = pd.DataFrame(columns=in_data_df.columns)
-
-    for index, row in in_data_df.iterrows():
+    # The settings each output was made with, recorded with the seed and
+    # SNR range of its draws
+    settings = dict(
+        noise_methods=loader_kwargs["noise_methods"],
+        noise_bank_dir=args.noise_bank_dir,
+    )
+    out_data_df = in_data_df.copy()
+    utt_ids = {}
+    jobs = []
+    for index, in_file_path in zip(in_data_df.index, in_data_df["file"]):
         # define the file paths
-        in_file_path = row["file"]
         wav_name = os.path.basename(in_file_path)
         noise_file_path = out_data_dir + "/wavs/{}".format(wav_name)
+        out_data_df.at[index, "file"] = noise_file_path
+        utt_ids[index] = os.path.splitext(wav_name)[0]
+
+        # Files completed with the same draws from an unchanged input wav
+        # are not augmented again
+        params_file = out_data_dir + "/noise_params/{}.json".format(utt_ids[index])
+        if not journal.done(
+            utt_ids[index],
+            outputs=[noise_file_path, params_file],
+            seed=seed,
+            snr_range=snr_range,
+            sources=[in_file_path],
+            **settings,
+        ):
+            jobs.append((index, in_file_path, noise_file_path, params_file))
+    if len(jobs) < len(in_data_df):
+        print(
+            "Resuming: {} of {} files already augmented".format(
+                len(in_data_df) - len(jobs), len(in_data_df)
+            )
+        )
+
+    chunks = [
+        jobs[i : i + args.chunk_size] for i in range(0, len(jobs), args.chunk_size)
+    ]
+    # The main process records the outputs as the chunks come back
+    try:
+        if args.num_workers > 1:
+            # The inventories and the noise bank are built here, once, and
+            # the workers only open them
+            init_noise_loader(loader_kwargs)
+            with ProcessPoolExecutor(
+                max_workers=args.num_workers,
+                initializer=init_noise_loader,
+                initargs=(loader_kwargs,),
+            ) as executor:
+                results = executor.map(
+                    partial(
+                        noise_augmentation_chunk,
+                        seed=seed,
+                        snr_range=snr_range,
+                        block_size=args.block_size,
+                    ),
+                    chunks,
+                )
+                for index, params in chain.from_iterable(results):
+                    journal.record(
+                        utt_ids[index],
+                        sources=[in_data_df.loc[index, "file"]],
+                        **params,
+                        **settings,
+                    )
+        elif chunks:
+            init_noise_loader(loader_kwargs)
+            for chunk in chunks:
+                for index, params in noise_augmentation_chunk(
+                    chunk, seed, snr_range, args.block_size
+                ):
+                    journal.record(
+                        utt_ids[index],
+                        sources=[in_data_df.loc[index, "file"]],
+                        **params,
+                        **settings,
+                    )
+    finally:
+        journal.close()
+
+    # copy the new file path and decision to the new CSV file, from the
+    # journal so that the resumed files get their noise type too
+    for index, utt_id in utt_ids.items():
+        out_data_df.at[index, "attack"] = "longform-{}".format(
+            journal.get(utt_id)["method"]
+        )
 
-        # TODO this is just in case there is a bug in the middle
-        # of the generation, since the noise type is not that important
-        # here, we skip it optionally
-        noise_type = "-"
-        # copy the new file path and decision to the new CSV file
-        new_row = row.copy()
-        if not os.path.exists(noise_file_path):
-            input_audio, sr = librosa.load(in_file_path, sr=16000)
-            input_audio, noise_type = noise_loader.add_noise(input_audio)
-            sf.write(noise_file_path, input_audio, sr)
-            new_row["attack"] = "longform-{}".format(noise_type)
-        new_row["file"] = noise_file_path
-        out_data_df.loc[index] = new_row
-
-    out_data_df.to_csv(out_data_dir + "/data.csv")
+    with atomic_output(out_data_dir + "/data.csv") as tmp_path:
+        out_data_df.to_csv(tmp_path)
 
     if os.path.exists(in_data_dir + "/spk2utt"):
         shutil.copyfile(in_data_dir + "/spk2utt", out_data_dir + "/spk2utt")
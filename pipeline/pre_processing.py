@@ -1,16 +1,50 @@
 """
 Perform silence trimming and volume normalization on the flac/wav file
-(Or any wav format that is readable by LibROSA)
+(Or any wav format that is readable by soundfile or LibROSA)
+
+Resumable after a crash, see utils/journal.py.
 """
 
 import argparse
 import os
 import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import chain
 
 import pandas as pd
-import librosa
 import soundfile as sf
 
+from utils.audio_io import load_audio, to_pcm16
+from utils.journal import Journal, atomic_output
+from utils.sv56 import sv56_normalize
+from utils.trimming import trim_bounds
+
+
+def trim_silence(
+    audio,
+    silence_threshold=-40,
+    frame_length=2048,
+    hop_length=512,
+):
+    """
+    Removes silence from the beginning and end of an in-memory waveform.
+    """
+
+    # Scan inward from both ends for the first and last non-silent
+    # frames, same bounds as librosa.effects.split
+    start, end = trim_bounds(
+        audio,
+        top_db=-silence_threshold,
+        frame_length=frame_length,
+        hop_length=hop_length,
+    )
+
+    # Slice the non-silent part of the audio
+    return audio[start:end]
+
 
 def remove_silence_single(
     input_file,
@@ -25,38 +59,33 @@ def remove_silence_single(
     """
 
     # Load audio file
-    audio, sample_rate = librosa.load(input_file, sr=sr)
+    audio, sample_rate = load_audio(input_file, sr=sr)
 
-    # Split the audio into non-silent intervals
-    non_silent_intervals = librosa.effects.split(
+    trimmed_audio = trim_silence(
         audio,
-        top_db=-silence_threshold,
+        silence_threshold=silence_threshold,
         frame_length=frame_length,
         hop_length=hop_length,
     )
 
-    # Efficiently find the first and last non-silent frames
-    if len(non_silent_intervals) > 0:
-        # Get the start of the first non-silent segment
-        start = non_silent_intervals[0][0]
-        # Get the end of the last non-silent segment
-        end = non_silent_intervals[-1][1]
-    else:
-        # If no non-silent part is found, we assume it's all silence, return an empty audio
-        start, end = 0, 0
-
-    # Slice the non-silent part of the audio
-    trimmed_audio = audio[start:end]
-
     # Save the processed audio to the output file
     sf.write(output_file, trimmed_audio, sample_rate)
+    return trimmed_audio, sample_rate
 
 
-def adjust_volume_sv56_single(input_wav_file, output_wav_file):
+def adjust_volume_single(audio, output_wav_file, sr=16000, level_norm=20):
+    """
+    Adjust the volume of the in-memory waveform to -level_norm dBov
+    by the NumPy implementation of P.56, and save it as 16-bit PCM
+    """
+    normalized_audio = sv56_normalize(audio, sr, -level_norm)
+    sf.write(output_wav_file, to_pcm16(normalized_audio), sr, subtype="PCM_16")
+
+
+def adjust_volume_sv56_single(input_wav_file, output_wav_file, level_norm=20):
     """
     Adjust the volume of the waveform by sv56 toolkit
     """
-    level_norm = 20
     os.system(
         "bash pipeline/utils/sub_sv56.sh {} {} {} 2>/dev/null".format(
             input_wav_file, output_wav_file, level_norm
@@ -66,6 +95,49 @@ def adjust_volume_sv56_single(input_wav_file, output_wav_file):
         shutil.copyfile(input_wav_file, output_wav_file)
 
 
+def pre_process_single(input_file, output_file, sr=16000, sv56_backend="sox"):
+    """
+    Decode, trim and level-normalize a waveform in memory, then write
+    the final 16-bit PCM file once. Returns the number of bytes written
+    and the input duration in seconds.
+    """
+    audio, sample_rate = load_audio(input_file, sr=sr)
+    trimmed_audio = trim_silence(audio)
+
+    if sv56_backend == "sox":
+        # sv56demo only works on files, so the trimmed audio goes
+        # through a temporary file which is removed afterwards
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(output_file)) as tmp_dir:
+            temp_file = os.path.join(tmp_dir, os.path.basename(output_file))
+            sf.write(temp_file, trimmed_audio, sample_rate)
+            adjust_volume_sv56_single(temp_file, output_file)
+            bytes_written = os.path.getsize(temp_file)
+    else:
+        adjust_volume_single(trimmed_audio, output_file, sr=sample_rate)
+        bytes_written = 0
+
+    return bytes_written + os.path.getsize(output_file), len(audio) / sample_rate
+
+
+def pre_process_chunk(jobs, sv56_backend="sox"):
+    """
+    Pre-process a chunk of (index, input file, output file) jobs.
+    Failures are returned as error messages instead of being raised,
+    so that a single bad file does not kill the whole run.
+    """
+    results = []
+    for index, in_file_path, out_file_path in jobs:
+        try:
+            with atomic_output(out_file_path) as tmp_path:
+                bytes_written, duration = pre_process_single(
+                    in_file_path, tmp_path, sv56_backend=sv56_backend
+                )
+            results.append((index, bytes_written, duration, None))
+        except Exception as e:
+            results.append((index, 0, 0.0, "{}: {}".format(type(e).__name__, e)))
+    return results
+
+
 def main():
     parser = argparse.ArgumentParser()
 
@@ -75,6 +147,26 @@ def main():
     parser.add_argument(
         "--out_data_dir", type=str, help="Output data directory", required=True
     )
+    parser.add_argument(
+        "--sv56_backend",
+        type=str,
+        default="sox",
+        choices=["sox", "numpy"],
+        help="Volume normalization by sox + sv56demo, or by the NumPy P.56 "
+        "(not yet checked against sv56demo on reference files)",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="Number of worker processes",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=32,
+        help="Number of files sent to a worker at once",
+    )
 
     args = parser.parse_args()
 
@@ -90,29 +182,122 @@ def main():
     # load the PD dataframe first
     in_data_df = pd.read_csv(in_data_dir + "/data.csv")
 
-    # Create an empty DataFrame with the same columns
-    out_data_df = pd.DataFrame(columns=in_data_df.columns)
+    # Outputs completed by a previous run of the stage
+    journal = Journal(out_data_dir + "/journal_pre_processing.jsonl")
 
-    for index, row in in_data_df.iterrows():
-        # define the file paths
-        in_file_path = row["file"]
+    # define the file paths, and skip the files already processed
+    jobs = []
+    out_file_paths = {}
+    utt_ids = {}
+    for index, in_file_path in in_data_df["file"].items():
         wav_name = os.path.basename(in_file_path)
-        out_file_path = out_data_dir + "/wavs/{}.wav".format(wav_name.split(".")[0])
-        temp_file_path = out_data_dir + "/wavs/{}.wav".format(
-            wav_name.split(".")[0] + "_temp"
+        utt_ids[index] = wav_name.split(".")[0]
+        out_file_paths[index] = out_data_dir + "/wavs/{}.wav".format(utt_ids[index])
+        if not journal.done(
+            utt_ids[index],
+            outputs=[out_file_paths[index]],
+            sources=[in_file_path],
+            sv56_backend=args.sv56_backend,
+        ):
+            jobs.append((index, in_file_path, out_file_paths[index]))
+    if len(jobs) < len(in_data_df):
+        print(
+            "Resuming: {} of {} files already processed".format(
+                len(in_data_df) - len(jobs), len(in_data_df)
+            )
         )
+    chunks = [
+        jobs[i : i + args.chunk_size] for i in range(0, len(jobs), args.chunk_size)
+    ]
 
-        # perform the normalization on single waveform
-        remove_silence_single(in_file_path, temp_file_path)
-        adjust_volume_sv56_single(temp_file_path, out_file_path)
+    # perform the trimming + normalization on chunks of waveforms,
+    # the results come back in the same order as the input rows and are
+    # recorded as they come
+    start_time = time.time()
+    worker = partial(pre_process_chunk, sv56_backend=args.sv56_backend)
+    errors = []
+    num_processed = 0
+    total_duration = 0.0
 
-        # copy the new file path and decision to the new CSV file
-        new_row = row.copy()
-        new_row["file"] = out_file_path
-        out_data_df.loc[index] = new_row
+    def record(chunk_results):
+        nonlocal num_processed, total_duration
+        for index, bytes_written, duration, error in chunk_results:
+            if error is not None:
+                errors.append((in_data_df.loc[index, "file"], error))
+                continue
+            num_processed += 1
+            total_duration += duration
+            journal.record(
+                utt_ids[index],
+                sources=[in_data_df.loc[index, "file"]],
+                sv56_backend=args.sv56_backend,
+                bytes=bytes_written,
+                duration=duration,
+            )
+
+    try:
+        if args.num_workers > 1:
+            with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+                record(chain.from_iterable(executor.map(worker, chunks)))
+        else:
+            for chunk in chunks:
+                record(worker(chunk))
+    finally:
+        journal.close()
+    elapsed = time.time() - start_time
+
+    # The files of this run and of the previous ones, from the journal
+    done_indices = [
+        index
+        for index, in_file_path in in_data_df["file"].items()
+        if journal.done(
+            utt_ids[index],
+            outputs=[out_file_paths[index]],
+            sources=[in_file_path],
+            sv56_backend=args.sv56_backend,
+        )
+    ]
+    total_bytes = 0
+    with atomic_output(out_data_dir + "/utt2bytes") as tmp_path:
+        with open(tmp_path, "w") as b:
+            for index in done_indices:
+                bytes_written = journal.get(utt_ids[index])["bytes"]
+                total_bytes += bytes_written
+                b.write("{} {}\n".format(out_file_paths[index], bytes_written))
+
+    # copy the new file path and decision to the new CSV file,
+    # keeping the original row order and index
+    out_data_df = in_data_df.loc[done_indices].copy()
+    out_data_df["file"] = [out_file_paths[index] for index in done_indices]
+    with atomic_output(out_data_dir + "/data.csv") as tmp_path:
+        out_data_df.to_csv(tmp_path)
+
+    if errors:
+        with open(out_data_dir + "/errors.txt", "w") as e:
+            for in_file_path, error in errors:
+                e.write("{} {}\n".format(in_file_path, error))
+        print(
+            "{} files failed, see {}".format(len(errors), out_data_dir + "/errors.txt")
+        )
 
-    out_data_df.to_csv(out_data_dir + "/data.csv")
     shutil.copyfile(in_data_dir + "/spk2utt", out_data_dir + "/spk2utt")
+    print(
+        "Wrote {} bytes for {} wav files ({:.0f} bytes per file on average)".format(
+            total_bytes, len(done_indices), total_bytes / max(len(done_indices), 1)
+        )
+    )
+    # Speed of this run, over the files it processed successfully
+    if total_duration > 0:
+        print(
+            "Processed {} files in {:.1f}s: {:.1f} files/s, real-time factor {:.4f}".format(
+                num_processed,
+                elapsed,
+                num_processed / max(elapsed, 1e-8),
+                elapsed / total_duration,
+            )
+        )
+    else:
+        print("Processed {} files in {:.1f}s".format(num_processed, elapsed))
     print(
         "Finish pre-processing wav files. New wav files are stored in {}".format(
             out_data_dir
@@ -0,0 +1,131 @@
+"""
+Audio loading shared by the pipeline stages.
+
+Files are read directly with soundfile when their native sample rate
+already matches the requested one, and resampled with a polyphase
+filter only when it has to. Formats that libsndfile cannot decode fall
+back to librosa.load.
+
+Run this file to compare it against librosa.load on some inputs:
+
+    python3 -m pipeline.utils.audio_io wav1.wav wav2.flac ...
+"""
+
+import argparse
+import io
+import time
+from math import gcd
+
+import numpy as np
+import soundfile as sf
+from scipy import signal
+
+
+def to_pcm16(audio):
+    """
+    Convert float samples in [-1, 1) to int16 with rounding and saturation
+    (the way sv56demo writes its output)
+    """
+    scaled = np.asarray(audio, dtype=np.float64) * 32768.0
+    scaled = np.trunc(scaled + np.copysign(0.5, scaled))
+    return np.clip(scaled, -32768, 32767).astype(np.int16)
+
+
+def pcm16_samples(audio):
+    """
+    The int16 samples that sf.write stores for float samples in a 16-bit
+    file, with the rounding of libsndfile rather than the one of to_pcm16
+    """
+    buffer = io.BytesIO()
+    sf.write(buffer, audio, 16000, format="RAW", subtype="PCM_16", endian="LITTLE")
+    return np.frombuffer(buffer.getvalue(), dtype="<i2").astype(np.int16)
+
+
+def resample(audio, orig_sr, target_sr):
+    """
+    Polyphase resampling of a float waveform along the first axis
+    """
+    if orig_sr == target_sr:
+        return audio
+    g = gcd(int(orig_sr), int(target_sr))
+    resampled = signal.resample_poly(audio, int(target_sr) // g, int(orig_sr) // g)
+    return resampled.astype(np.float32)
+
+
+def load_audio(path, sr=16000, dtype="float32", mono=True):
+    """
+    Load an audio file as (audio, sample rate).
+
+    sr=None keeps the native sample rate. dtype is "float32" (samples in
+    [-1, 1) as with librosa.load) or "int16".
+    """
+    try:
+        with sf.SoundFile(path) as f:
+            native_sr = f.samplerate
+            direct = (sr is None or sr == native_sr) and (f.channels == 1 or not mono)
+            # int16 files are read as they are when no processing is needed
+            audio = f.read(dtype=dtype if direct else "float32", always_2d=True)
+    except sf.LibsndfileError:
+        import librosa
+
+        audio, native_sr = librosa.load(path, sr=None, mono=False)
+        audio = np.atleast_2d(audio).T
+        direct = False
+
+    if mono:
+        audio = audio.mean(axis=1) if audio.shape[1] > 1 else audio[:, 0]
+    if sr is not None and sr != native_sr:
+        audio = resample(audio, native_sr, sr)
+    sr = native_sr if sr is None else sr
+
+    if not direct:
+        audio = to_pcm16(audio) if dtype == "int16" else audio.astype(dtype)
+    return audio, sr
+
+
+def audio_duration(path):
+    """
+    Duration of an audio file in seconds, from the header when possible
+    """
+    try:
+        info = sf.info(path)
+        return info.frames / info.samplerate
+    except sf.LibsndfileError:
+        audio, sr = load_audio(path, sr=None)
+        return len(audio) / sr
+
+
+# Micro-benchmark against librosa.load on typical inputs
+def benchmark(paths, sr=16000, repeat=20):
+    import librosa
+
+    def timed(load):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for path in paths:
+                load(path)
+        return (time.perf_counter() - start) / (repeat * len(paths))
+
+    # Warm up the caches and the lazy imports of both
+    for path in paths:
+        librosa.load(path, sr=sr)
+        load_audio(path, sr=sr)
+
+    librosa_time = timed(lambda path: librosa.load(path, sr=sr))
+    for dtype in ["float32", "int16"]:
+        load_time = timed(lambda path: load_audio(path, sr=sr, dtype=dtype))
+        print(
+            "load_audio({}): {:.3f} ms/file, librosa.load: {:.3f} ms/file, "
+            "speed-up {:.1f}x".format(
+                dtype, load_time * 1e3, librosa_time * 1e3, librosa_time / load_time
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("audio_files", nargs="+", help="Audio files to load")
+    parser.add_argument("--sr", type=int, default=16000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    benchmark(args.audio_files, sr=args.sr, repeat=args.repeat)
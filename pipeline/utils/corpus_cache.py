@@ -0,0 +1,120 @@
+"""
+Decoded corpus cache for the concatenation stage.
+
+The short wavs are decoded once into one contiguous int16 buffer, with
+an index of (offset, length) per file. The buffer lives in
+multiprocessing.shared_memory or in a memory-mapped file, so that worker
+processes can attach to it and slice the parts of a long-form file
+instead of decoding them again from disk.
+"""
+
+import os
+
+import numpy as np
+import soundfile as sf
+from multiprocessing import shared_memory
+
+
+class CorpusCache(object):
+    def __init__(self, index, backend, location, samplerate=16000, owner=False):
+        # index: file path -> (offset, length) in samples
+        self.index = index
+        self.backend = backend
+        self.location = location
+        self.samplerate = samplerate
+        # Only the process that created the buffer frees it
+        self.owner = owner
+
+        num_samples = sum(length for _, length in index.values())
+        if backend == "shm":
+            self.shm = shared_memory.SharedMemory(name=location)
+            self.buffer = np.ndarray(num_samples, dtype=np.int16, buffer=self.shm.buf)
+        elif backend == "mmap":
+            self.shm = None
+            self.buffer = np.memmap(
+                location,
+                dtype=np.int16,
+                mode="r+" if owner else "r",
+                shape=(num_samples,),
+            )
+        else:
+            raise ValueError("Unknown cache backend {}".format(backend))
+
+    @classmethod
+    def build(
+        cls, wav_paths, memory_budget, backend="shm", mmap_path=None, samplerate=16000
+    ):
+        """
+        Decode the wavs into a new cache. Returns None if the decoded
+        corpus does not fit in memory_budget bytes, or if the files are
+        not mono at the expected sample rate.
+        """
+        wav_paths = list(dict.fromkeys(wav_paths))
+        index = {}
+        offset = 0
+        for path in wav_paths:
+            info = sf.info(path)
+            if info.samplerate != samplerate or info.channels != 1:
+                return None
+            index[path] = (offset, info.frames)
+            offset += info.frames
+        if offset * 2 > memory_budget or offset == 0:
+            return None
+
+        if backend == "shm":
+            # Created here, then attached by name like in the workers
+            shm = shared_memory.SharedMemory(create=True, size=offset * 2)
+            location = shm.name
+            shm.close()
+        else:
+            location = mmap_path
+            np.memmap(location, dtype=np.int16, mode="w+", shape=(offset,)).flush()
+
+        cache = cls(index, backend, location, samplerate=samplerate, owner=True)
+        for path, (start, length) in index.items():
+            with sf.SoundFile(path) as f:
+                f.read(dtype="int16", out=cache.buffer[start : start + length])
+        return cache
+
+    @classmethod
+    def attach(cls, handle):
+        """
+        Attach to a cache created in another process from its handle()
+        """
+        index, backend, location, samplerate = handle
+        return cls(index, backend, location, samplerate=samplerate)
+
+    def handle(self):
+        """
+        Picklable description of the cache for worker processes
+        """
+        return self.index, self.backend, self.location, self.samplerate
+
+    def __contains__(self, path):
+        return path in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def nbytes(self):
+        return self.buffer.nbytes
+
+    def get(self, path):
+        """
+        Zero-copy view of the decoded samples of a file
+        """
+        start, length = self.index[path]
+        return self.buffer[start : start + length]
+
+    def close(self):
+        """
+        Detach from the buffer, and free it if this process created it
+        """
+        self.buffer = None
+        if self.backend == "shm":
+            self.shm.close()
+            if self.owner:
+                self.shm.unlink()
+        elif self.owner and os.path.exists(self.location):
+            os.remove(self.location)
@@ -5,7 +5,8 @@ Get the utt2dur file
 import os
 import sys
 import pandas as pd
-import librosa
+
+from audio_io import audio_duration
 
 
 # Main function: generate utt2dur file from wavs in input directory
@@ -28,9 +29,8 @@ def main():
                 print("{} was not generated successfully in source".format(file))
                 continue
 
-            # Load wav file and calculate duration
-            y, sr = librosa.load(file, sr=None)
-            dur = len(y) / sr
+            # Read the duration from the file header
+            dur = audio_duration(file)
             # Write to utt2dur file
             f.write(f"{file} {dur:.3f}\n")
 
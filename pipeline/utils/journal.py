@@ -0,0 +1,136 @@
+"""
+Append-only journal of the outputs completed by a stage, for resuming.
+
+Every output is first written under a temporary name and renamed once it
+is complete (see atomic_output), then recorded as one line of JSON with
+the parameters it was made with:
+
+    {"key": "<utterance>", "samples": 64000, ...}
+
+An output without a line in the journal is redone on restart, e.g. a
+wav that was being written when the run was killed, and a line cut by
+the crash is ignored. So is an output whose files were deleted since,
+or whose input files changed: the size and modification time of the
+sources of every output are recorded with it (see file_state). A
+restarted stage skips the keys recorded with the same parameters, one
+dict lookup and a few stats per file, and rebuilds its manifests from
+the records. When a key is recorded more than once, the last record
+wins. A stage run without a seed takes the one of the run it resumes
+from the journal (see Journal.last), so that it makes the same draws.
+"""
+
+import json
+import os
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_output(path):
+    """
+    Yield a temporary path next to path, with the same extension, that
+    is renamed to path when the block exits without error
+    """
+    tmp_path = os.path.join(
+        os.path.dirname(path), ".tmp{}-{}".format(os.getpid(), os.path.basename(path))
+    )
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# Size and modification time of an input file, None if it does not exist
+def file_state(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class Journal(object):
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        # Value of every parameter in the last line that has it
+        self.latest = {}
+        self.file = None
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Cut by a crash while it was written
+                        continue
+                    self.records[record["key"]] = record
+                    self.latest.update(record)
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, key):
+        return self.records.get(key)
+
+    def last(self, name):
+        """
+        Value of a parameter in the last line that has it, or None,
+        e.g. the seed of the previous run
+        """
+        return self.latest.get(name)
+
+    def done(self, key, outputs=(), sources=(), **params):
+        """
+        Whether key was recorded, with these values of the parameters and
+        from these input files, unchanged since, and its output files all
+        still exist
+        """
+        record = self.records.get(key)
+        if record is None:
+            return False
+        if any(record.get(name) != value for name, value in params.items()):
+            return False
+        if record.get("sources") != list(sources) or record.get("source_states") != [
+            file_state(path) for path in sources
+        ]:
+            return False
+        return all(os.path.exists(path) for path in outputs)
+
+    def record(self, key, sources=(), **params):
+        """
+        Record a completed output, once its files have been renamed, with
+        the state of the input files it was made from.
+        The line is flushed, so that it survives the process
+        """
+        record = dict(
+            key=key,
+            sources=list(sources),
+            source_states=[file_state(path) for path in sources],
+            **params
+        )
+        if self.file is None:
+            # A line cut by a crash is closed first, so that it does not
+            # swallow the next one
+            cut = False
+            if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+                with open(self.path, "rb") as f:
+                    f.seek(-1, os.SEEK_END)
+                    cut = f.read(1) != b"\n"
+            self.file = open(self.path, "a")
+            if cut:
+                self.file.write("\n")
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        self.records[key] = record
+        self.latest.update(record)
+
+    def close(self):
+        if self.file is not None:
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
@@ -0,0 +1,143 @@
+"""
+Memory-mapped bank of the MUSAN noise, speech and music subsets.
+
+Each category is packed once into one contiguous int16 file
+<bank_dir>/<category>.int16, and <bank_dir>/manifest.txt records where
+every source file is in it, one line per file:
+
+    <category> <path> <offset> <length> <mtime_ns>
+
+Files that cannot be decoded are recorded with an offset of -1, and left
+out of the bank. The modification time of the sources is checked when
+the bank is opened again, and it is only rebuilt when MUSAN has changed.
+Noise windows are then zero-copy slices of the memory maps, instead of
+a full decode of a (often minutes-long) track per utterance.
+"""
+
+import glob
+import os
+
+import numpy as np
+import soundfile as sf
+
+from .audio_io import load_audio
+from .journal import atomic_output
+
+
+CATEGORIES = ["noise", "speech", "music"]
+
+
+# Category, path and modification time of the MUSAN wavs
+def scan_sources(musan_path):
+    sources = []
+    for path in sorted(glob.glob(os.path.join(musan_path, "*/*/*.wav"))):
+        sources.append((path.split("/")[-3], path, os.stat(path).st_mtime_ns))
+    return sources
+
+
+class NoiseBank(object):
+    def __init__(self, bank_dir):
+        self.bank_dir = bank_dir
+        # category -> list of paths, path -> (category, offset, length)
+        self.files = {category: [] for category in CATEGORIES}
+        self.index = {}
+        self.sources = []
+        with open(os.path.join(bank_dir, "manifest.txt"), "r") as m:
+            for line in m:
+                category, path, offset, length, mtime_ns = line.split()
+                self.sources.append((category, path, int(mtime_ns)))
+                if int(offset) >= 0:
+                    self.files[category].append(path)
+                    self.index[path] = (category, int(offset), int(length))
+
+        self.buffers = {}
+        for category in CATEGORIES:
+            bank_file = os.path.join(bank_dir, category + ".int16")
+            if os.path.getsize(bank_file) > 0:
+                self.buffers[category] = np.memmap(bank_file, dtype=np.int16, mode="r")
+            else:
+                self.buffers[category] = np.zeros(0, dtype=np.int16)
+
+    @classmethod
+    def build(cls, musan_path, bank_dir, samplerate=16000, sources=None):
+        """
+        Open the bank in bank_dir, after packing the MUSAN wavs into it if
+        it does not exist yet or if the sources have changed since.
+        sources: (category, path, mtime_ns) of the MUSAN wavs, e.g. from
+        the noise inventory, instead of scanning musan_path
+        """
+        if sources is None:
+            sources = scan_sources(musan_path)
+        sources = [source for source in sources if source[0] in CATEGORIES]
+        manifest = os.path.join(bank_dir, "manifest.txt")
+        if os.path.exists(manifest):
+            try:
+                bank = cls(bank_dir)
+                if set(bank.sources) == set(sources):
+                    return bank
+            except (ValueError, OSError):
+                print("Bank in {} cannot be read, rebuilt".format(bank_dir))
+
+        os.makedirs(bank_dir, exist_ok=True)
+        lines = []
+        for category in CATEGORIES:
+            # Lengths come from the headers, files that need resampling
+            # or downmixing are decoded once here
+            entries = []
+            for source in sources:
+                if source[0] != category:
+                    continue
+                path = source[1]
+                try:
+                    info = sf.info(path)
+                    if info.samplerate == samplerate and info.channels == 1:
+                        entries.append((source, info.frames, None))
+                    else:
+                        audio, _ = load_audio(path, sr=samplerate, dtype="int16")
+                        entries.append((source, len(audio), audio))
+                except (sf.LibsndfileError, RuntimeError):
+                    print("{} cannot be decoded, skipped".format(path))
+                    lines.append("{} {} -1 0 {}\n".format(*source))
+
+            num_samples = sum(length for _, length, _ in entries)
+            # Written aside and renamed, as an older bank may still be mapped
+            bank_file = os.path.join(bank_dir, category + ".int16")
+            with atomic_output(bank_file) as tmp_path:
+                if num_samples == 0:
+                    open(tmp_path, "wb").close()
+                    continue
+                buffer = np.memmap(
+                    tmp_path, dtype=np.int16, mode="w+", shape=(num_samples,)
+                )
+                offset = 0
+                for (_, path, mtime_ns), length, audio in entries:
+                    if audio is None:
+                        with sf.SoundFile(path) as f:
+                            f.read(dtype="int16", out=buffer[offset : offset + length])
+                    else:
+                        buffer[offset : offset + length] = audio
+                    lines.append(
+                        "{} {} {} {} {}\n".format(
+                            category, path, offset, length, mtime_ns
+                        )
+                    )
+                    offset += length
+                buffer.flush()
+                del buffer
+
+        # The manifest is written last, a partial build is never reused
+        with atomic_output(manifest) as tmp_path:
+            with open(tmp_path, "w") as m:
+                m.writelines(lines)
+        print("Packed {} MUSAN wavs into {}".format(len(lines), bank_dir))
+        return cls(bank_dir)
+
+    def __contains__(self, path):
+        return path in self.index
+
+    def get(self, path):
+        """
+        Zero-copy int16 view of the samples of a noise file
+        """
+        category, offset, length = self.index[path]
+        return self.buffers[category][offset : offset + length]
@@ -0,0 +1,106 @@
+"""
+Cached inventory of the MUSAN and RIR wavs.
+
+Listing <root>/*/*/*.wav walks every directory of the corpus, which is
+slow on a networked filesystem and is repeated by every process that
+creates an augmenter. The inventory is written once to a text file, one
+line per directory and per usable wav:
+
+    dir <directory> <mtime_ns>
+    <category> <path> <duration> <samplerate> <mtime_ns>
+
+It is reused as long as the modification times of the directories it
+was built from are unchanged, i.e. no wav was added, removed or renamed.
+Empty files and files that cannot be decoded are left out when it is
+built, so the augmenter never draws them.
+"""
+
+import glob
+import os
+
+import soundfile as sf
+
+from .journal import atomic_output
+
+
+# Modification times of the directories matched by <root>/*/*
+def directory_mtimes(root):
+    directories = [root] + sorted(
+        d for d in glob.glob(os.path.join(root, "*")) if os.path.isdir(d)
+    )
+    for subdir in directories[1:]:
+        directories += sorted(
+            d for d in glob.glob(os.path.join(subdir, "*")) if os.path.isdir(d)
+        )
+    return [(d, os.stat(d).st_mtime_ns) for d in directories]
+
+
+# Probe every wav of the corpus from its header
+def scan_inventory(root):
+    entries = []
+    for path in sorted(glob.glob(os.path.join(root, "*/*/*.wav"))):
+        try:
+            info = sf.info(path)
+        except (sf.LibsndfileError, RuntimeError):
+            print("{} cannot be decoded, excluded".format(path))
+            continue
+        if info.frames == 0:
+            print("{} is empty, excluded".format(path))
+            continue
+        entries.append(
+            (
+                path.split("/")[-3],
+                path,
+                info.frames / info.samplerate,
+                info.samplerate,
+                os.stat(path).st_mtime_ns,
+            )
+        )
+    return entries
+
+
+def load_inventory(root, inventory_file):
+    """
+    Return the (category, path, duration, samplerate, mtime_ns) of the
+    usable wavs under root, from inventory_file if it is still valid,
+    otherwise after scanning root and writing inventory_file again
+    """
+    if not os.path.isdir(root):
+        return []
+    mtimes = directory_mtimes(root)
+    if os.path.exists(inventory_file):
+        cached_mtimes = []
+        entries = []
+        with open(inventory_file, "r") as f:
+            for line in f:
+                fields = line.split()
+                if fields[0] == "dir":
+                    cached_mtimes.append((fields[1], int(fields[2])))
+                else:
+                    category, path, duration, samplerate, mtime_ns = fields
+                    entries.append(
+                        (
+                            category,
+                            path,
+                            float(duration),
+                            int(samplerate),
+                            int(mtime_ns),
+                        )
+                    )
+        if cached_mtimes == mtimes:
+            return entries
+
+    entries = scan_inventory(root)
+    os.makedirs(os.path.dirname(os.path.abspath(inventory_file)), exist_ok=True)
+    with atomic_output(inventory_file) as tmp_path:
+        with open(tmp_path, "w") as f:
+            for directory, mtime_ns in mtimes:
+                f.write("dir {} {}\n".format(directory, mtime_ns))
+            for category, path, duration, samplerate, mtime_ns in entries:
+                f.write(
+                    "{} {} {:.6f} {} {}\n".format(
+                        category, path, duration, samplerate, mtime_ns
+                    )
+                )
+    print("Wrote the inventory of {} wavs to {}".format(len(entries), inventory_file))
+    return entries
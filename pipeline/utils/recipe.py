@@ -0,0 +1,121 @@
+"""
+Compact recipe of the long-form combinations.
+
+The short utterances are stored once as a table (path, duration in
+milliseconds, label), and every long-form file as one row of an integer
+matrix of utterance ids. The recipe is saved as a .npz file, and can be
+exported to (or read back from) the src_comb_metadata_*.txt format:
+
+    <name> <path1,path2,...> <dur1,dur2,...> <b|s,b|s,...> <bonafide|spoof>
+"""
+
+import numpy as np
+
+
+LABELS = np.array(["b", "s"])
+
+
+class Recipe(object):
+    def __init__(self, names, decisions, parts, paths, durations_ms, labels):
+        self.names = np.asarray(names, dtype=str)  # long-form file names
+        self.decisions = np.asarray(decisions, dtype=str)  # bonafide or spoof
+        self.parts = np.asarray(parts, dtype=np.int32)  # utterance ids per file
+        self.paths = np.asarray(paths, dtype=str)  # utterance table
+        self.durations_ms = np.asarray(durations_ms, dtype=np.int32)
+        self.labels = np.asarray(labels, dtype=np.int8)  # 0 bonafide, 1 spoof
+
+    def __len__(self):
+        return len(self.names)
+
+    def row(self, i):
+        """
+        (name, paths, durations in seconds, labels, decision) of a file
+        """
+        parts = self.parts[i]
+        parts = parts[parts >= 0]
+        return (
+            str(self.names[i]),
+            self.paths[parts].tolist(),
+            (self.durations_ms[parts] / 1000).tolist(),
+            LABELS[self.labels[parts]].tolist(),
+            str(self.decisions[i]),
+        )
+
+    def save(self, path):
+        np.savez(
+            path,
+            names=self.names,
+            decisions=self.decisions,
+            parts=self.parts,
+            paths=self.paths,
+            durations_ms=self.durations_ms,
+            labels=self.labels,
+        )
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a .npz recipe, or parse a src_comb_metadata_*.txt file
+        """
+        if path.endswith(".txt"):
+            return cls.from_text(path)
+        with np.load(path) as recipe:
+            return cls(
+                recipe["names"],
+                recipe["decisions"],
+                recipe["parts"],
+                recipe["paths"],
+                recipe["durations_ms"],
+                recipe["labels"],
+            )
+
+    def to_text(self, path):
+        """
+        Export to the src_comb_metadata_*.txt format
+        """
+        durations = np.char.mod("%.3f", self.durations_ms / 1000)
+        labels = LABELS[self.labels]
+        with open(path, "w") as f:
+            for name, parts, decision in zip(self.names, self.parts, self.decisions):
+                parts = parts[parts >= 0]
+                f.write(
+                    "{} {} {} {} {}\n".format(
+                        name,
+                        ",".join(self.paths[parts]),
+                        ",".join(durations[parts]),
+                        ",".join(labels[parts]),
+                        decision,
+                    )
+                )
+
+    @classmethod
+    def from_text(cls, path):
+        names, decisions, parts = [], [], []
+        utt_ids = {}
+        durations_ms, labels = [], []
+        with open(path, "r") as f:
+            for line in f:
+                name, wav_paths, durs, wav_labels, decision = line.split()
+                row = []
+                for wav, dur, label in zip(
+                    wav_paths.split(","), durs.split(","), wav_labels.split(",")
+                ):
+                    if wav not in utt_ids:
+                        utt_ids[wav] = len(utt_ids)
+                        durations_ms.append(round(float(dur) * 1000))
+                        labels.append(1 if label == "s" else 0)
+                    row.append(utt_ids[wav])
+                names.append(name)
+                decisions.append(decision)
+                parts.append(row)
+        # Rows of a ragged file are padded with -1
+        width = max((len(row) for row in parts), default=0)
+        parts = [row + [-1] * (width - len(row)) for row in parts]
+        return cls(
+            names,
+            decisions,
+            np.array(parts, dtype=np.int32).reshape(len(names), width),
+            list(utt_ids),
+            durations_ms,
+            labels,
+        )
@@ -0,0 +1,151 @@
+"""
+Reverberation by block overlap-add FFT convolution.
+
+The input is cut in blocks of nfft - len(rir) + 1 samples, every block
+is multiplied by the spectrum of the RIR, and the overlapping tails are
+added back, so the cost grows linearly with the length of the input.
+The output keeps the length of the input, like
+scipy.signal.convolve(audio, rir, mode="full")[: len(audio)].
+
+StreamingReverb applies the same convolution to an input given block
+by block, carrying the tail of each block over to the next one.
+
+The normalized RIR spectra are kept in an LRU cache keyed by the RIR
+path and the FFT size. Run this file to check the engine against
+scipy.signal.convolve and time it on inputs of growing length:
+
+    python3 -m pipeline.utils.reverb [rir.wav]
+"""
+
+import argparse
+import time
+from functools import lru_cache
+
+import numpy as np
+import scipy.fft
+from scipy import signal
+
+from .audio_io import load_audio
+
+
+BATCH_BLOCKS = 64  # Blocks transformed at once, to bound the memory
+
+
+# Smallest power of two FFT that fits at least two RIR lengths
+def fft_size(rir_length, min_nfft=4096):
+    return max(min_nfft, 1 << int(np.ceil(np.log2(2 * rir_length))))
+
+
+# RIR normalized to unit energy, as in rir_musan_loader.add_rev_single
+def normalize_rir(rir):
+    rir = np.asarray(rir, dtype=np.float64)
+    return (rir / np.sqrt(np.sum(rir**2) + 1e-8)).astype(np.float32)
+
+
+@lru_cache(maxsize=512)
+def rir_spectrum(rir_path, nfft=None, samplerate=16000):
+    """
+    (spectrum, RIR length, nfft) of a RIR file. With nfft=None the FFT
+    size is chosen from the RIR length.
+    """
+    rir, _ = load_audio(rir_path, sr=samplerate)
+    rir = normalize_rir(rir)
+    if nfft is None:
+        nfft = fft_size(len(rir))
+    return scipy.fft.rfft(rir, nfft), len(rir), nfft
+
+
+def fft_convolve(audio, spectrum, rir_length, nfft, full=False):
+    """
+    Convolve audio with the RIR of the given spectrum, keeping the first
+    len(audio) samples of the full convolution, or len(audio) + len(rir) - 1
+    with full=True
+    """
+    audio = np.asarray(audio, dtype=np.float32)
+    num_samples = len(audio)
+    block = nfft - rir_length + 1
+    tail = rir_length - 1
+    # The tail of the last block spills over the end, then is dropped
+    out = np.zeros(num_samples + nfft, dtype=np.float32)
+
+    for start in range(0, num_samples, block * BATCH_BLOCKS):
+        chunk = audio[start : start + block * BATCH_BLOCKS]
+        num_blocks = -(-len(chunk) // block)
+        frames = np.zeros((num_blocks, block), dtype=np.float32)
+        frames.reshape(-1)[: len(chunk)] = chunk
+        y = scipy.fft.irfft(scipy.fft.rfft(frames, nfft, axis=1) * spectrum, nfft)
+
+        # Each block overlaps the next one by the RIR tail only, since
+        # the block is longer than the tail
+        y[1:, :tail] += y[:-1, block : block + tail]
+        end = start + num_blocks * block
+        out[start:end] += y[:, :block].reshape(-1)
+        out[end : end + tail] += y[-1, block : block + tail]
+    return out[: num_samples + tail] if full else out[:num_samples]
+
+
+def reverberate(audio, rir_path, samplerate=16000):
+    spectrum, rir_length, nfft = rir_spectrum(rir_path, None, samplerate)
+    return fft_convolve(audio, spectrum, rir_length, nfft)
+
+
+class StreamingReverb(object):
+    """
+    Reverberation of an input given block by block, with the tail of each
+    block carried over to the next one. The concatenated outputs are the
+    output of reverberate on the whole input.
+    """
+
+    def __init__(self, rir_path, samplerate=16000):
+        self.spectrum, self.rir_length, self.nfft = rir_spectrum(
+            rir_path, None, samplerate
+        )
+        self.carry = np.zeros(self.rir_length - 1, dtype=np.float32)
+
+    def process(self, block):
+        y = fft_convolve(block, self.spectrum, self.rir_length, self.nfft, full=True)
+        y[: len(self.carry)] += self.carry
+        self.carry = y[len(block) :].copy()
+        return y[: len(block)]
+
+
+# Compare with scipy.signal.convolve, and time both on growing inputs
+def benchmark(rir_path=None, durations=[15, 30, 60, 120, 240], samplerate=16000):
+    rng = np.random.default_rng(0)
+    if rir_path is not None:
+        rir, _ = load_audio(rir_path, sr=samplerate)
+    else:
+        # Exponentially decaying noise, like a 0.5 s RT60 room
+        t = np.arange(samplerate // 2) / samplerate
+        rir = rng.standard_normal(len(t)) * np.exp(-6.9 * t / 0.5)
+    rir = normalize_rir(rir)
+    nfft = fft_size(len(rir))
+    spectrum = scipy.fft.rfft(rir, nfft)
+
+    for duration in durations:
+        audio = (rng.standard_normal(duration * samplerate) * 0.1).astype(np.float32)
+        start = time.perf_counter()
+        out = fft_convolve(audio, spectrum, len(rir), nfft)
+        fft_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        ref = signal.convolve(audio, rir, mode="full")[: len(audio)]
+        scipy_time = time.perf_counter() - start
+        print(
+            "{:4d} s: overlap-add {:7.1f} ms ({:.2f} ms per s of audio), "
+            "scipy.signal.convolve {:7.1f} ms, max diff {:.1e}".format(
+                duration,
+                fft_time * 1e3,
+                fft_time * 1e3 / duration,
+                scipy_time * 1e3,
+                np.abs(out - ref).max(),
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("rir_file", nargs="?", default=None, help="RIR wav file")
+    parser.add_argument("--durations", type=str, default="15,30,60,120,240")
+    args = parser.parse_args()
+    benchmark(args.rir_file, [int(d) for d in args.durations.split(",")])
@@ -0,0 +1,176 @@
+"""
+Index of the segments of long-form files, read on demand.
+
+Instead of one small wav per segment, long_form_segmentation.py
+--index_only writes an index of the segments into the long-form wavs,
+out_data_dir/segment_index.txt, one line per segment:
+
+    <segment_id> <long-form wav> <start sample> <end sample> <spoof proportion> <decision>
+
+SegmentReader serves any segment by seeking into its long-form wav, and
+keeps the last files it opened in a small LRU of handles:
+
+    reader = SegmentReader("SEG4/segment_index.txt")
+    segment_id, audio, portion_s, decision = reader[0]
+
+The samples are the ones of the segment wavs that the segmentation
+would have written. Run this file to time random reads through the
+index, and of the segment wavs if they were written too:
+
+    python3 -m pipeline.utils.segment_index SEG4/segment_index.txt [--wav_dir SEG4/wavs]
+"""
+
+import argparse
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+import soundfile as sf
+
+from .journal import atomic_output
+
+
+def write_segment_index(index_file, entries):
+    """
+    entries: (segment_id, long-form wav, start, end, spoof proportion,
+    decision) of every segment
+    """
+    with atomic_output(index_file) as tmp_path:
+        with open(tmp_path, "w") as f:
+            for entry in entries:
+                f.write("{} {} {} {} {} {}\n".format(*entry))
+
+
+class SegmentReader(object):
+    def __init__(self, index_file, max_open_files=16, dtype="float32"):
+        """
+        max_open_files: number of long-form wavs kept open
+        dtype: "float32" (samples in [-1, 1) as with load_audio) or "int16"
+        """
+        self.segment_ids = []
+        self.paths = []
+        starts = []
+        ends = []
+        portions = []
+        self.decisions = []
+        with open(index_file, "r") as f:
+            for line in f:
+                segment_id, path, start, end, portion_s, decision = line.split()
+                self.segment_ids.append(segment_id)
+                self.paths.append(path)
+                starts.append(int(start))
+                ends.append(int(end))
+                portions.append(float(portion_s))
+                self.decisions.append(decision)
+        self.starts = np.array(starts, dtype=np.int64)
+        self.ends = np.array(ends, dtype=np.int64)
+        self.portions = np.array(portions)
+        self.positions = {
+            segment_id: i for i, segment_id in enumerate(self.segment_ids)
+        }
+
+        self.dtype = dtype
+        self.max_open_files = max_open_files
+        self.handles = OrderedDict()
+
+    def __len__(self):
+        return len(self.segment_ids)
+
+    def __getitem__(self, i):
+        """
+        (segment_id, samples, spoof proportion, decision) of the i-th
+        segment, or of the segment of this ID
+        """
+        if isinstance(i, str):
+            i = self.positions[i]
+        elif i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("Segment {} out of range".format(i))
+        audio = self.read(i)
+        return self.segment_ids[i], audio, self.portions[i], self.decisions[i]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    # Open handle of a long-form wav, the least recently used one is closed
+    def handle(self, path):
+        f = self.handles.get(path)
+        if f is not None:
+            self.handles.move_to_end(path)
+            return f
+        if len(self.handles) >= self.max_open_files:
+            self.handles.popitem(last=False)[1].close()
+        f = sf.SoundFile(path)
+        self.handles[path] = f
+        return f
+
+    def read(self, i):
+        f = self.handle(self.paths[i])
+        f.seek(self.starts[i])
+        return f.read(self.ends[i] - self.starts[i], dtype=self.dtype)
+
+    def close(self):
+        for f in self.handles.values():
+            f.close()
+        self.handles.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Random reads through the index, and of the segment wavs in wav_dir
+def benchmark(index_file, wav_dir=None, num_reads=2000, max_open_files=16, seed=0):
+    rng = np.random.default_rng(seed)
+    with SegmentReader(index_file, max_open_files=max_open_files) as reader:
+        order = rng.integers(0, len(reader), num_reads)
+        print(
+            "{} segments in {} long-form wavs, {} random reads".format(
+                len(reader), len(set(reader.paths)), num_reads
+            )
+        )
+
+        start = time.perf_counter()
+        for i in order:
+            reader.read(i)
+        index_time = time.perf_counter() - start
+        print(
+            "Index ({} open files): {:.0f} segments/s".format(
+                max_open_files, num_reads / index_time
+            )
+        )
+
+        if wav_dir is not None:
+            wav_paths = [
+                os.path.join(wav_dir, reader.segment_ids[i] + ".wav") for i in order
+            ]
+            start = time.perf_counter()
+            for wav_path in wav_paths:
+                sf.read(wav_path, dtype="float32")
+            wav_time = time.perf_counter() - start
+            print(
+                "Segment wavs: {:.0f} segments/s, index/wavs {:.2f}x".format(
+                    num_reads / wav_time, wav_time / index_time
+                )
+            )
+
+            # Both give the same samples
+            for i, wav_path in list(zip(order, wav_paths))[:100]:
+                assert np.array_equal(
+                    reader.read(i), sf.read(wav_path, dtype="float32")[0]
+                ), wav_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("index_file", help="segment_index.txt of the segmentation")
+    parser.add_argument("--wav_dir", type=str, default=None, help="Segment wavs")
+    parser.add_argument("--num_reads", type=int, default=2000)
+    parser.add_argument("--max_open_files", type=int, default=16)
+    args = parser.parse_args()
+    benchmark(args.index_file, args.wav_dir, args.num_reads, args.max_open_files)
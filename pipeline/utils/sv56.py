@@ -0,0 +1,259 @@
+"""
+NumPy implementation of the ITU-T P.56 active speech level (method B),
+following the speech voltmeter of sv56demo in the ITU-T STL.
+
+The measurement and the gain are computed on the waveform already in
+memory, so the pre-processing stage does not need to shell out to
+sox + sv56demo for each utterance. The sox/sv56demo path is kept in
+sub_sv56.sh, and this file can be run as a script to compare both:
+
+    python3 -m pipeline.utils.sv56 wav1.wav wav2.wav ...
+
+A file passes when both outputs have the same active level within
+LEVEL_TOL dB and no sample differs by more than SAMPLE_TOL LSB. sox and
+sv56demo must be in PATH. Without files, only the NumPy implementation
+is checked, on synthetic signals of known level (unit_test).
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+
+import numpy as np
+import soundfile as sf
+from scipy import signal
+from scipy.ndimage import maximum_filter1d
+
+from .audio_io import to_pcm16
+
+
+T = 0.03  # Time constant of the envelope smoothing, in seconds
+H = 0.20  # Hangover time, in seconds
+M = 15.9  # Margin between the threshold and the active level, in dB
+THRES_NO = 15  # Number of thresholds (one per bit of 16-bit audio)
+
+LEVEL_TOL = 0.1  # Tolerance on the active level against sv56demo, in dB
+SAMPLE_TOL = 2  # Tolerance on the normalized samples against sv56demo, in LSB
+
+
+def bin_interp(upcount, lwcount, upthr, lwthr, margin, tol):
+    """
+    Bisection between two thresholds to find the point where the
+    level minus the threshold equals the margin (as in sv-p56.c)
+    """
+    tol = abs(tol)
+
+    # The extreme counts may already be the true active value
+    if abs((upcount - upthr) - margin) < tol:
+        return upcount
+    if abs((lwcount - lwthr) - margin) < tol:
+        return lwcount
+
+    midcount = (upcount + lwcount) / 2.0
+    midthr = (upthr + lwthr) / 2.0
+    iterno = 1
+    while True:
+        diff = (midcount - midthr) - margin
+        if abs(diff) <= tol:
+            break
+        # Relax the tolerance by 10% if not met in 20 iterations
+        iterno += 1
+        if iterno > 20:
+            tol *= 1.1
+        if diff > tol:
+            lwcount, lwthr = midcount, midthr
+        elif diff < -tol:
+            upcount, upthr = midcount, midthr
+        midcount = (upcount + lwcount) / 2.0
+        midthr = (upthr + lwthr) / 2.0
+    return midcount
+
+
+def active_speech_level(audio, sr=16000):
+    """
+    Measure the active speech level of a waveform in [-1, 1).
+
+    Returns (active level in dBov, activity factor, long-term level in dBov).
+    The active level is None when no activity is detected.
+    """
+    audio = np.asarray(audio, dtype=np.float64)
+    if audio.ndim > 1:
+        audio = audio.mean(axis=-1)
+    num_samples = len(audio)
+    if num_samples == 0:
+        return None, 0.0, None
+
+    g = np.exp(-1.0 / (T * sr))
+    hangover = int(np.floor(H * sr + 0.5))
+    thresholds = 2.0 ** (np.arange(THRES_NO) - 15)
+
+    # Two cascaded first-order smoothers of the rectified signal
+    sq = np.dot(audio, audio)
+    envelope = signal.lfilter([1 - g], [1, -g], np.abs(audio))
+    envelope = signal.lfilter([1 - g], [1, -g], envelope)
+
+    # A sample is active for a threshold if the envelope crossed it
+    # within the last `hangover` samples, i.e. the running maximum over
+    # the causal window [n - hangover, n] is above the threshold
+    size = hangover + 1
+    running_max = maximum_filter1d(
+        envelope, size=size, origin=(size - 1) // 2, mode="constant", cval=0.0
+    )
+    running_max.sort()
+    counts = num_samples - np.searchsorted(running_max, thresholds, side="left")
+
+    long_term_level = 10 * np.log10(sq / num_samples + 1e-20)
+    if counts[0] == 0 or sq == 0:
+        return None, 0.0, long_term_level
+
+    active_db = np.full(THRES_NO, np.inf)
+    nonzero = counts > 0
+    active_db[nonzero] = 10 * np.log10(sq / counts[nonzero])
+    threshold_db = 20 * np.log10(thresholds)
+    delta = active_db - threshold_db
+
+    below = np.flatnonzero(delta <= M)
+    if len(below) == 0:
+        # The margin is never reached, take the highest active threshold
+        active_level = active_db[np.flatnonzero(nonzero)[-1]]
+    elif below[0] == 0:
+        active_level = active_db[0]
+    else:
+        j = below[0]
+        active_level = bin_interp(
+            active_db[j], active_db[j - 1], threshold_db[j], threshold_db[j - 1], M, 0.5
+        )
+
+    activity_factor = 10 ** ((long_term_level - active_level) / 10)
+    return active_level, activity_factor, long_term_level
+
+
+def sv56_normalize(audio, sr=16000, level=-26):
+    """
+    Scale the waveform so that its active speech level is `level` dBov.
+    The waveform is returned unchanged if no activity is detected.
+    """
+    active_level, _, _ = active_speech_level(audio, sr)
+    if active_level is None:
+        return audio
+    factor = 10 ** ((level - active_level) / 20)
+    return audio * factor
+
+
+def compare_with_sv56demo(
+    wav_files, level_norm=20, level_tol=LEVEL_TOL, sample_tol=SAMPLE_TOL
+):
+    """
+    Run sub_sv56.sh and the NumPy implementation on the same files,
+    and report the difference of the normalized outputs.
+    Returns the number of files out of tolerance
+    """
+    for tool in ["sox", "sv56demo"]:
+        if shutil.which(tool) is None:
+            raise RuntimeError("{} not in PATH, cannot compare".format(tool))
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sub_sv56.sh")
+    level_diffs = []
+    max_diffs = []
+    failed = 0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for wav_file in wav_files:
+            ref_file = os.path.join(tmp_dir, os.path.basename(wav_file))
+            subprocess.run(
+                ["bash", script, os.path.abspath(wav_file), ref_file, str(level_norm)],
+                cwd=tmp_dir,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            if not os.path.exists(ref_file):
+                print("{}: sv56demo produced no output".format(wav_file))
+                failed += 1
+                continue
+
+            ref_audio, _ = sf.read(ref_file, dtype="int16")
+            audio, sr = sf.read(wav_file, dtype="int16")
+            audio = audio / 32768.0
+            out_audio = to_pcm16(sv56_normalize(audio, sr, -level_norm))
+
+            ref_level, _, _ = active_speech_level(ref_audio / 32768.0, sr)
+            out_level, _, _ = active_speech_level(out_audio / 32768.0, sr)
+            if ref_level is None or out_level is None:
+                level_diffs.append(0.0 if ref_level == out_level else np.inf)
+            else:
+                level_diffs.append(abs(ref_level - out_level))
+            if len(ref_audio) != len(out_audio):
+                max_diffs.append(np.inf)
+            else:
+                diff = np.abs(ref_audio.astype(np.int32) - out_audio.astype(np.int32))
+                max_diffs.append(diff.max() if len(diff) else 0)
+            ok = level_diffs[-1] <= level_tol and max_diffs[-1] <= sample_tol
+            failed += not ok
+            print(
+                "{}: sv56demo {} dBov, numpy {} dBov, max sample diff {}{}".format(
+                    wav_file,
+                    ref_level,
+                    out_level,
+                    max_diffs[-1],
+                    "" if ok else ", OUT OF TOLERANCE",
+                )
+            )
+    if max_diffs:
+        print(
+            "Compared {} files: largest level difference {:.3f} dB (tolerance {}), "
+            "largest sample difference {} (tolerance {}), {} failed".format(
+                len(max_diffs),
+                max(level_diffs),
+                level_tol,
+                max(max_diffs),
+                sample_tol,
+                failed,
+            )
+        )
+    return failed
+
+
+def unit_test():
+    sr = 16000
+    t = np.arange(4 * sr) / sr
+    sine = 0.5 * np.sin(2 * np.pi * 440 * t)
+    sine_db = 20 * np.log10(0.5 / np.sqrt(2))
+
+    # A continuous tone is active all along, at its RMS level
+    level, activity, long_term = active_speech_level(sine, sr)
+    assert abs(long_term - sine_db) < 1e-6
+    assert abs(level - sine_db) < 0.05 and activity > 0.99, (level, activity)
+
+    # Silence lowers the long-term level but not the active level
+    # (beyond the hangover of 0.2 s after the tone)
+    padded = np.concatenate([sine, np.zeros(4 * sr)])
+    level, activity, long_term = active_speech_level(padded, sr)
+    assert abs(long_term - (sine_db - 10 * np.log10(2))) < 1e-6
+    assert abs(level - sine_db) < 0.5 and 0.5 < activity < 0.55, (level, activity)
+
+    # Normalization reaches the target level, also after 16-bit rounding
+    for target in [-26, -20]:
+        out = to_pcm16(sv56_normalize(padded, sr, target)) / 32768.0
+        assert abs(active_speech_level(out, sr)[0] - target) < 0.01
+
+    # No activity: no level, and the waveform is left unchanged
+    silence = np.zeros(sr)
+    assert active_speech_level(silence, sr)[0] is None
+    assert sv56_normalize(silence, sr) is silence
+    print("unit_test passed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("wav_files", nargs="*", help="16-bit wav files to compare")
+    parser.add_argument("--level_norm", type=int, default=20)
+    parser.add_argument("--level_tol", type=float, default=LEVEL_TOL)
+    parser.add_argument("--sample_tol", type=int, default=SAMPLE_TOL)
+    args = parser.parse_args()
+    if args.wav_files:
+        failed = compare_with_sv56demo(
+            args.wav_files, args.level_norm, args.level_tol, args.sample_tol
+        )
+        raise SystemExit(1 if failed else 0)
+    unit_test()
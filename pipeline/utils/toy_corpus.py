@@ -0,0 +1,58 @@
+"""
+Small random corpora for the unit tests of the long-form stages.
+
+A p1-like directory of 30 short int16 wavs (the first 15 bonafide, the
+others spoof), a MUSAN-like noise corpus and simulated RIRs, all drawn
+from the numpy generator of the test:
+
+    rng = np.random.default_rng(0)
+    wav_files = write_toy_data_dir(tmp_dir + "/p1", rng)
+    write_toy_musan(tmp_dir + "/musan", rng)
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import soundfile as sf
+
+
+# Write short random wavs in data_dir/wavs, with their utt2dur, data.csv
+# and an empty spk2utt, and return the wav paths
+def write_toy_data_dir(data_dir, rng, num_wavs=30):
+    os.makedirs(data_dir + "/wavs")
+    wav_files = []
+    rows = []
+    with open(data_dir + "/utt2dur", "w") as u:
+        for i in range(num_wavs):
+            wav_path = data_dir + "/wavs/utt{}.wav".format(i)
+            audio = rng.integers(-3000, 3000, int(rng.integers(8000, 32000)))
+            sf.write(wav_path, audio.astype(np.int16), 16000, subtype="PCM_16")
+            u.write("{} {:.3f}\n".format(wav_path, len(audio) / 16000))
+            wav_files.append(wav_path)
+            label = "bonafide" if i < num_wavs // 2 else "spoof"
+            rows.append([wav_path, label, "spk{}".format(i % 2), "-"])
+    pd.DataFrame(rows, columns=["file", "label", "speaker", "attack"]).to_csv(
+        data_dir + "/data.csv"
+    )
+    open(data_dir + "/spk2utt", "w").close()
+    return wav_files
+
+
+# Write a MUSAN-like noise corpus, of 8 wavs per category
+def write_toy_musan(musan_path, rng):
+    for noisecat in ["noise", "speech", "music"]:
+        noise_dir = os.path.join(musan_path, noisecat, "set")
+        os.makedirs(noise_dir)
+        for i in range(8):
+            noise = rng.normal(0, 0.1, int(rng.integers(4000, 40000)))
+            sf.write(noise_dir + "/{}.wav".format(i), noise, 16000)
+
+
+# Write a few decaying random RIRs, laid out like the simulated RIRs
+def write_toy_rirs(rir_path, rng):
+    rir_dir = os.path.join(rir_path, "smallroom", "Room001")
+    os.makedirs(rir_dir)
+    for i in range(4):
+        rir = rng.normal(0, 0.1, 4000) * np.exp(-np.arange(4000) / 800)
+        sf.write(rir_dir + "/{}.wav".format(i), rir, 16000)
@@ -0,0 +1,208 @@
+"""
+Edge-scan silence trimming.
+
+Gives the same bounds as taking the start of the first and the end of
+the last interval of librosa.effects.split, but instead of computing the
+RMS of every frame and building every non-silent interval, it scans
+inward from both ends in blocks of frames and stops at the first frame
+above the threshold.
+
+The frame RMS and dB values are computed with the same float32
+operations as librosa.feature.rms and librosa.amplitude_to_db, so the
+bounds are sample-identical. Run this file to check it against librosa:
+
+    python3 -m pipeline.utils.trimming [wav1.wav wav2.wav ...]
+"""
+
+import sys
+
+import numpy as np
+import soundfile as sf
+
+
+AMIN = 1e-5  # Same floor on the amplitude as librosa.amplitude_to_db
+
+
+def _frame_span(first, last, frame_length, hop_length, num_samples):
+    """
+    Range of original samples covered by frames [first, last) of the
+    zero-padded (centered) signal
+    """
+    pad = frame_length // 2
+    start = max(first * hop_length - pad, 0)
+    end = min((last - 1) * hop_length + frame_length - pad, num_samples)
+    return start, max(end, start)
+
+
+def _frame_power(samples, first, last, frame_length, hop_length):
+    """
+    Mean square of frames [first, last) computed like librosa.feature.rms,
+    given the original samples within _frame_span(first, last)
+    """
+    pad = frame_length // 2
+    seg_start = first * hop_length
+    seg_end = (last - 1) * hop_length + frame_length
+    segment = np.zeros(seg_end - seg_start, dtype=np.float32)
+    offset = max(pad - seg_start, 0)
+    segment[offset : offset + len(samples)] = samples
+
+    frames = np.lib.stride_tricks.sliding_window_view(segment, frame_length)
+    frames = frames[::hop_length].T
+    return np.mean(np.power(frames, 2, dtype=np.float32), axis=-2)
+
+
+def _to_db(power):
+    # The RMS amplitude goes back to power in librosa.amplitude_to_db
+    return 10.0 * np.log10(np.maximum(AMIN**2, np.square(np.sqrt(power))))
+
+
+def _scan(frame_power, frames, ref_db, top_db, block_frames):
+    """
+    Return the first non-silent frame of `frames` (a range scanned in
+    order, forward or backward), or None if all of them are silent
+    """
+    step = 1 if frames.step > 0 else -1
+    for block_start in range(0, len(frames), block_frames):
+        block = frames[block_start : block_start + block_frames]
+        first, last = min(block[0], block[-1]), max(block[0], block[-1]) + 1
+        db = _to_db(frame_power(first, last))
+        db -= ref_db
+        non_silent = np.flatnonzero((db > -top_db)[::step])
+        if len(non_silent) > 0:
+            return block[non_silent[0]]
+    return None
+
+
+def _scan_edges(
+    frame_power, num_frames, num_samples, ref_db, top_db, hop_length, block_frames
+):
+    first = _scan(frame_power, range(num_frames), ref_db, top_db, block_frames)
+    if first is None:
+        return 0, 0
+    last = _scan(
+        frame_power, range(num_frames - 1, first - 1, -1), ref_db, top_db, block_frames
+    )
+    start = min(first * hop_length, num_samples)
+    end = min((last + 1) * hop_length, num_samples)
+    return start, end
+
+
+def trim_bounds(audio, top_db=40, frame_length=2048, hop_length=512, block_frames=32):
+    """
+    Return (start, end) sample indices of the non-silent part of a mono
+    float32 waveform, identical to the first and last interval of
+    librosa.effects.split with the same parameters
+    """
+    audio = np.asarray(audio, dtype=np.float32)
+    num_samples = len(audio)
+    num_frames = 1 + num_samples // hop_length
+
+    def frame_power(first, last):
+        start, end = _frame_span(first, last, frame_length, hop_length, num_samples)
+        return _frame_power(audio[start:end], first, last, frame_length, hop_length)
+
+    # Reference of ref=np.max, the loudest frame. It is located with a
+    # float64 running sum of squares, then the candidates are recomputed
+    # exactly in float32
+    cumsum = np.zeros(num_samples + 1)
+    np.cumsum(np.square(audio, dtype=np.float64), out=cumsum[1:])
+    frame_starts = np.arange(num_frames) * hop_length - frame_length // 2
+    lower = np.clip(frame_starts, 0, num_samples)
+    upper = np.clip(frame_starts + frame_length, 0, num_samples)
+    energy = cumsum[upper] - cumsum[lower]
+    candidates = np.flatnonzero(energy >= energy.max() * (1 - 1e-4))
+    ref_power = max(frame_power(i, i + 1)[0] for i in candidates)
+    ref_db = _to_db(ref_power)
+
+    return _scan_edges(
+        frame_power, num_frames, num_samples, ref_db, top_db, hop_length, block_frames
+    )
+
+
+def trim_bounds_file(
+    path,
+    top_db=40,
+    frame_length=2048,
+    hop_length=512,
+    ref_db=None,
+    block_frames=32,
+):
+    """
+    Same as trim_bounds on a mono file, reading blocks of frames from
+    both ends through soundfile.SoundFile.
+
+    With a fixed reference level `ref_db` (dB of the frame RMS, 0 for a
+    full-scale signal) only the silent edges are decoded. Without it, the
+    reference is the loudest frame as in librosa, which takes one
+    streaming pass over the file before scanning the edges.
+    """
+    with sf.SoundFile(path) as f:
+        num_samples = f.frames
+        num_frames = 1 + num_samples // hop_length
+
+        def frame_power(first, last):
+            start, end = _frame_span(first, last, frame_length, hop_length, num_samples)
+            f.seek(start)
+            samples = f.read(end - start, dtype="float32", always_2d=True)[:, 0]
+            return _frame_power(samples, first, last, frame_length, hop_length)
+
+        if ref_db is None:
+            ref_power = np.float32(0.0)
+            chunk = block_frames * 64
+            for first in range(0, num_frames, chunk):
+                last = min(first + chunk, num_frames)
+                ref_power = max(ref_power, frame_power(first, last).max())
+            ref_db = _to_db(ref_power)
+
+        return _scan_edges(
+            frame_power,
+            num_frames,
+            num_samples,
+            ref_db,
+            top_db,
+            hop_length,
+            block_frames,
+        )
+
+
+# Regression test against librosa.effects.split
+def unit_test():
+    import librosa
+
+    def librosa_bounds(audio):
+        intervals = librosa.effects.split(
+            audio, top_db=40, frame_length=2048, hop_length=512
+        )
+        if len(intervals) == 0:
+            return 0, 0
+        return intervals[0][0], intervals[-1][1]
+
+    rng = np.random.default_rng(0)
+    signals = [np.zeros(0, dtype=np.float32), np.zeros(8000, dtype=np.float32)]
+    for _ in range(200):
+        # Speech-like bursts with silent or low-level edges of random length
+        length = int(rng.integers(100, 80000))
+        audio = rng.standard_normal(length) * rng.uniform(1e-4, 0.5)
+        envelope = np.zeros(length)
+        for _ in range(int(rng.integers(1, 5))):
+            a, b = np.sort(rng.integers(0, length, 2))
+            envelope[a:b] = rng.uniform(0.005, 1.0)
+        audio = (audio * (envelope + rng.uniform(0, 1e-3))).astype(np.float32)
+        signals.append(audio)
+    for path in sys.argv[1:]:
+        audio, _ = sf.read(path, dtype="float32", always_2d=True)
+        signals.append(audio[:, 0])
+
+    for i, audio in enumerate(signals):
+        expected = librosa_bounds(audio)
+        assert trim_bounds(audio) == expected, (i, trim_bounds(audio), expected)
+    for path in sys.argv[1:]:
+        audio, _ = sf.read(path, dtype="float32", always_2d=True)
+        assert trim_bounds_file(path) == librosa_bounds(audio[:, 0]), path
+    print(
+        "trim_bounds matches librosa.effects.split on {} signals".format(len(signals))
+    )
+
+
+if __name__ == "__main__":
+    unit_test()
@@ -0,0 +1,318 @@
+"""
+Virtual long-form dataset, synthesized on demand from a recipe.
+
+A long-form file is fully described by its row in the recipe of the
+concatenation stage (src_comb_metadata_*.npz or .txt) and, for the noisy
+version, by the SNR range and a seed. Instead of writing every long-form
+and segmented wav to disk, this dataset concatenates the short wavs and
+adds the noise when an item is requested:
+
+    dataset = VirtualLongForm(recipe_file, snr_range=[0, 10], seed=0)
+    name, audio, decision, attack = dataset[0]
+    for name, audio, decision, attack in dataset:
+        ...
+
+With segment_length, the items are the segments of the long-form files
+instead, named <long-form name>_<N> like in long_form_segmentation.py.
+
+The noise of a long-form file only depends on (seed, name), and the
+samples are quantized to 16 bits, so that the files written with
+
+    python3 pipeline/virtual_long_form.py materialize \
+        --recipe p2_data_dir/src_comb_metadata_mc_3_7.npz \
+        --out_data_dir out_dir [--snr_range 0_10 --seed 0 --segment_length 4]
+
+are sample-identical to the items of the dataset.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import soundfile as sf
+
+from noise_augmentation import (
+    DEFAULT_NOISE_METHODS,
+    MUSAN_DIR,
+    RIR_DIR,
+    add_noise_pcm16,
+    rir_musan_loader,
+    utterance_rng,
+)
+from utils.audio_io import pcm16_samples, to_pcm16
+from utils.recipe import Recipe
+from utils.toy_corpus import write_toy_data_dir, write_toy_musan
+
+
+# Read a short wav of the corpus as int16, like the concatenation stage
+def read_source(path, samplerate=16000):
+    with sf.SoundFile(path) as f:
+        if f.samplerate != samplerate or f.channels != 1:
+            raise ValueError(
+                "{} is {} Hz with {} channels, expected {} Hz mono".format(
+                    path, f.samplerate, f.channels, samplerate
+                )
+            )
+        return f.read(dtype="int16")
+
+
+class VirtualLongForm(object):
+    def __init__(
+        self,
+        recipe_file,
+        snr_range=None,
+        seed=0,
+        segment_length=None,
+        musan_path=MUSAN_DIR,
+        rir_path=RIR_DIR,
+        noise_bank_dir=None,
+        inventory_dir=None,
+        noise_methods=DEFAULT_NOISE_METHODS,
+        samplerate=16000,
+        cache_size=1024,
+    ):
+        """
+        recipe_file: src_comb_metadata_*.npz or .txt of the concatenation
+        snr_range: [low, high] SNR of the noise in dB, None for no noise
+        segment_length: length of the segments in seconds, None for the
+        whole long-form files
+        noise_bank_dir: memory-mapped bank of MUSAN, see utils/noise_bank.py
+        inventory_dir: cached MUSAN/RIR lists, see utils/noise_inventory.py
+        cache_size: number of decoded short wavs kept in memory
+        """
+        self.recipe = Recipe.load(recipe_file)
+        self.seed = seed
+        self.samplerate = samplerate
+        self.augmenter = None
+        if snr_range is not None:
+            self.augmenter = rir_musan_loader(
+                musan_path,
+                rir_path,
+                samplerate=samplerate,
+                snr_range=snr_range,
+                noise_bank_dir=noise_bank_dir,
+                inventory_dir=inventory_dir,
+                noise_methods=noise_methods,
+            )
+
+        # LRU caches of the decoded short wavs and of the last long-form
+        # files, which are reused by consecutive segments
+        self.read_source = lru_cache(maxsize=cache_size)(read_source)
+        self.long_form = lru_cache(maxsize=2)(self._long_form)
+
+        self.segment_samples = None
+        if segment_length is not None:
+            self.segment_samples = int(segment_length * samplerate)
+            self._index_segments()
+
+    # Table of (long-form file, start sample) of every segment
+    def _index_segments(self):
+        recipe = self.recipe
+        used = np.unique(recipe.parts[recipe.parts >= 0])
+        self.lengths = np.zeros(len(recipe.paths), dtype=np.int64)
+        self.lengths[used] = [sf.info(recipe.paths[i]).frames for i in used]
+
+        padded = np.where(recipe.parts >= 0, recipe.parts, 0)
+        part_lengths = np.where(recipe.parts >= 0, self.lengths[padded], 0)
+        totals = part_lengths.sum(axis=1)
+        counts = -(-totals // self.segment_samples)
+
+        self.segment_files = np.repeat(np.arange(len(recipe)), counts)
+        first = np.cumsum(counts) - counts
+        segment_ids = np.arange(counts.sum()) - np.repeat(first, counts)
+        self.segment_starts = segment_ids * self.segment_samples
+        self.totals = totals
+
+    def __len__(self):
+        if self.segment_samples is None:
+            return len(self.recipe)
+        return len(self.segment_files)
+
+    def __getitem__(self, i):
+        """
+        (name, float32 samples, decision, attack) of the i-th item
+        """
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("Item {} out of range".format(i))
+        if self.segment_samples is None:
+            name, _, _, _, decision = self.recipe.row(i)
+            audio, noise_type = self.long_form(i)
+            return name, audio / np.float32(32768.0), decision, attack(noise_type)
+        return self.segment(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    # Concatenate and optionally add noise to the i-th long-form file
+    def _long_form(self, i):
+        name, paths, _, _, _ = self.recipe.row(i)
+        audio = np.concatenate(
+            [self.read_source(path, self.samplerate) for path in paths]
+        )
+        if self.augmenter is None:
+            return audio, None
+
+        # The noise of a file only depends on the seed and its name
+        # Same samples as the staged and fused p3 wavs: float32 noise adding,
+        # then the quantization of their 16-bit writes
+        noisy_audio, noise_type = add_noise_pcm16(
+            self.augmenter, audio, rng=utterance_rng(self.seed, name)
+        )
+        return pcm16_samples(noisy_audio), noise_type
+
+    # Slice the j-th segment out of its long-form file
+    def segment(self, j):
+        i = self.segment_files[j]
+        start = self.segment_starts[j]
+        end = min(start + self.segment_samples, self.totals[i])
+        name = "{}_{}".format(self.recipe.names[i], start // self.segment_samples + 1)
+        audio, _ = self.long_form(i)
+
+        # Proportion of the samples of the segment that come from spoofs
+        parts = self.recipe.parts[i]
+        parts = parts[parts >= 0]
+        part_ends = np.cumsum(self.lengths[parts])
+        part_starts = part_ends - self.lengths[parts]
+        overlap = np.clip(
+            np.minimum(part_ends, end) - np.maximum(part_starts, start), 0, None
+        )
+        spoof_samples = overlap[self.recipe.labels[parts] == 1].sum()
+        portion_s = spoof_samples / (end - start)
+        decision = "spoof" if portion_s > 0.0 else "bonafide"
+        return name, audio[start:end] / np.float32(32768.0), decision, "longform"
+
+
+# Attack column of data.csv, as written by the noise augmentation stage
+def attack(noise_type):
+    return "longform" if noise_type is None else "longform-{}".format(noise_type)
+
+
+# Write the items of a virtual dataset as wavs, data.csv and trials
+def materialize(dataset, out_data_dir, speaker="multi"):
+    os.makedirs(out_data_dir + "/wavs", exist_ok=True)
+    rows = []
+    with open(out_data_dir + "/asvspoof2019_trials.txt", "w") as w:
+        for name, audio, decision, attack_type in dataset:
+            wav_path = out_data_dir + "/wavs/{}.wav".format(name)
+            sf.write(wav_path, to_pcm16(audio), dataset.samplerate, subtype="PCM_16")
+            w.write("{} {} - - {}\n".format(name, name, decision))
+            rows.append([wav_path, decision, speaker, attack_type])
+
+    out_data_df = pd.DataFrame(rows, columns=["file", "label", "speaker", "attack"])
+    out_data_df.to_csv(out_data_dir + "/data.csv")
+    print("Materialized {} wav files in {}".format(len(rows), out_data_dir))
+
+
+# Simple unit test: lazy and materialized items must be sample-identical
+def unit_test():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        from long_form_concat import concatenate_audio, create_random_combination_batch
+
+        rng = np.random.default_rng(0)
+        wav_files = write_toy_data_dir(tmp_dir + "/in", rng)
+        write_toy_musan(tmp_dir + "/musan", rng)
+
+        recipe = create_random_combination_batch(
+            wav_files[:15],
+            wav_files[15:],
+            tmp_dir + "/in/utt2dur",
+            tmp_dir,
+            num_bonafides=4,
+            num_spoofs=8,
+            seed=0,
+        )
+        recipe_file = tmp_dir + "/src_comb_metadata_mc_3_7.npz"
+
+        # Without noise, the items are the outputs of the concatenation
+        dataset = VirtualLongForm(recipe_file)
+        for i in range(len(recipe)):
+            _, paths, _, _, _ = recipe.row(i)
+            expected = concatenate_audio(paths) / np.float32(32768.0)
+            assert np.array_equal(dataset[i][1], expected), i
+
+        for segment_length in [None, 1.5]:
+            options = dict(
+                snr_range=[0, 10],
+                seed=3,
+                segment_length=segment_length,
+                musan_path=tmp_dir + "/musan",
+            )
+            out_data_dir = tmp_dir + "/out_{}".format(segment_length)
+            materialize(VirtualLongForm(recipe_file, **options), out_data_dir)
+
+            # A fresh dataset, read in reverse order
+            dataset = VirtualLongForm(recipe_file, **options)
+            out_data_df = pd.read_csv(out_data_dir + "/data.csv")
+            assert len(out_data_df) == len(dataset)
+            for i in reversed(range(len(dataset))):
+                name, audio, decision, attack_type = dataset[i]
+                row = out_data_df.iloc[i]
+                written, _ = sf.read(row["file"], dtype="float32")
+                assert os.path.basename(row["file"]) == name + ".wav"
+                assert np.array_equal(audio, written), name
+                assert (row["label"], row["attack"]) == (decision, attack_type)
+        print("Lazy and materialized long-form items are sample-identical")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    materialize_parser = subparsers.add_parser(
+        "materialize", help="Write the items of a recipe to disk"
+    )
+    materialize_parser.add_argument(
+        "--recipe",
+        type=str,
+        help="src_comb_metadata_*.npz or .txt file of the concatenation",
+        required=True,
+    )
+    materialize_parser.add_argument(
+        "--out_data_dir", type=str, help="Output data directory", required=True
+    )
+    # Noise is added when the SNR range is given, e.g. 0_10
+    materialize_parser.add_argument("--snr_range", type=str, default=None)
+    materialize_parser.add_argument("--seed", type=int, default=0)
+    materialize_parser.add_argument("--noise_bank_dir", type=str, default=None)
+    materialize_parser.add_argument("--inventory_dir", type=str, default=None)
+    materialize_parser.add_argument(
+        "--noise_methods",
+        type=str,
+        default=",".join(DEFAULT_NOISE_METHODS),
+        help="Comma-separated methods, passed as --noise_methods=-,reverb,...",
+    )
+    materialize_parser.add_argument("--segment_length", type=float, default=None)
+    materialize_parser.add_argument("--cache_size", type=int, default=1024)
+
+    args = parser.parse_args()
+
+    snr_range = None
+    if args.snr_range is not None:
+        snr_range = [int(i) for i in args.snr_range.split("_")]
+    dataset = VirtualLongForm(
+        args.recipe,
+        snr_range=snr_range,
+        seed=args.seed,
+        segment_length=args.segment_length,
+        noise_bank_dir=args.noise_bank_dir,
+        inventory_dir=args.inventory_dir,
+        noise_methods=args.noise_methods.split(","),
+        cache_size=args.cache_size,
+    )
+    speaker = "single" if "_sc_" in os.path.basename(args.recipe) else "multi"
+    materialize(dataset, args.out_data_dir, speaker=speaker)
+
+
+if __name__ == "__main__":
+    # unit_test()
+    main()
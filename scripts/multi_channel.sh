@@ -16,9 +16,16 @@ set -e
 stage=0
 
 noise_snr_range="0_10" # The level range of SNR of noise, pos_snr: 10_30
+noise_methods="-,babble,music,noise,babble-music" # Noise types drawn per wave, add reverb for RIRs
+noise_bank_dir=data/Database/musan_bank # Memory-mapped MUSAN noise bank, packed on first use
+inventory_dir=data/Database/noise_inventory # Cached MUSAN/RIR file lists, scanned on first use
 single_speaker=false # Whether we only concatenate wavs from same speaker at p2
 
-segment_length=4
+segment_length=4 # Segment length in seconds, or comma-separated lengths (e.g. 1,2,4,8) cut in one pass
+segment_index_only=false # Write an index of the segments into the long-form wavs (see pipeline/utils/segment_index.py) instead of segment wavs
+
+num_workers=1 # Number of worker processes for the stages that support it
+cache_memory_mb=0 # Memory budget of the decoded corpus cache at concatenation, 0 to disable
 
 num_bonafides=2580 # Number of bonafide audios to generate
 num_spoofs=22800 # Number of spoofed audios to generate
@@ -33,6 +40,7 @@ p3_data_dir=data/asvspoof2019/LA/mc_p3/dev
 if [ $stage -le 0 ]; then
     echo "$0: Stage 0: Perform pre-processing on the audio, on $in_data_dir"
     python3 pipeline/pre_processing.py \
+        --num_workers $num_workers \
         --in_data_dir $in_data_dir \
         --out_data_dir $p1_data_dir
 fi
@@ -42,9 +50,13 @@ if [ $stage -le 1 ]; then
     python3 pipeline/utils/get_utt2dur.py $p1_data_dir
 
     python3 pipeline/noise_augmentation.py \
+        --num_workers $num_workers \
         --in_data_dir $p1_data_dir \
         --out_data_dir $p2_data_dir \
-	--snr_range "$noise_snr_range"
+	--snr_range "$noise_snr_range" \
+        --noise_bank_dir $noise_bank_dir \
+        --inventory_dir $inventory_dir \
+        --noise_methods="$noise_methods"
 fi
 
 if [ $stage -le 2 ]; then
@@ -63,6 +75,8 @@ if [ $stage -le 2 ]; then
         single_speaker_flag=""
     fi
     python3 pipeline/long_form_concat.py $single_speaker_flag \
+        --cache_memory_mb $cache_memory_mb \
+        --num_workers $num_workers \
         --num_bonafides $num_bonafides \
         --num_spoofs $num_spoofs \
         --in_data_dir $p2_data_dir \
@@ -71,9 +85,14 @@ fi
 
 if [ $stage -le 3 ]; then
     echo "$0: Perform segmentation on the long form audio"
-    python3 pipeline/long_form_segmentation.py --segment_length $segment_length \
+    if $segment_index_only; then
+        segment_index_flag="--index_only"
+    else
+        segment_index_flag=""
+    fi
+    python3 pipeline/long_form_segmentation.py $segment_index_flag --segment_length $segment_length \
         --in_data_dir $p3_data_dir \
-        --out_data_dir $p3_data_dir/SEG$segment_length
+        --out_data_dir "$p3_data_dir/SEG{}"
 fi
 
 if [ $stage -le 4 ]; then
@@ -82,7 +101,11 @@ if [ $stage -le 4 ]; then
     python3 pipeline/utils/write_ultra_deepfake_csv.py \
         --in_data_dir $p3_data_dir
 
-    python3 pipeline/utils/get_utt2dur.py $p3_data_dir/SEG$segment_length
-    python3 pipeline/utils/write_ultra_deepfake_csv.py \
-        --in_data_dir $p3_data_dir/SEG$segment_length
+    if ! $segment_index_only; then
+        for length in $(echo $segment_length | tr ',' ' '); do
+            python3 pipeline/utils/get_utt2dur.py $p3_data_dir/SEG$length
+            python3 pipeline/utils/write_ultra_deepfake_csv.py \
+                --in_data_dir $p3_data_dir/SEG$length
+        done
+    fi
 fi